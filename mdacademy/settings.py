@@ -131,6 +131,6 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases
 django_heroku.settings(locals())
 
-db_from_env = dj_database_url.config(conn_max_age=500)
+db_from_env = dj_database_url.config(conn_max_age=int(os.environ.get('DB_CONN_MAX_AGE', 500)))
 DATABASES['default'].update(db_from_env)
 del DATABASES['default']['OPTIONS']['sslmode']
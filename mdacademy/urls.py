@@ -15,8 +15,13 @@ Including another URLconf
 """
 from django.urls import path
 
+from time_chart import api
 from time_chart.admin import admin_site
+from time_chart.webhook import webhook
 
 urlpatterns = [
     path('admin/', admin_site.urls),
+    path('bot/<str:secret>/', webhook, name='bot-webhook'),
+    path('api/places/', api.places, name='api-places'),
+    path('api/availability/', api.availability, name='api-availability'),
 ]
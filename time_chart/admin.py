@@ -1,26 +1,29 @@
 import datetime as dt
-import io
-from collections import defaultdict
-from itertools import zip_longest
 
-import xlsxwriter
 from dal import autocomplete
 from django import forms
 from django.contrib import admin
 from django.db import connection
-from django.db.models import Count
 from django.forms.widgets import TextInput
-from django.http import HttpResponse
-from django.urls import path
-
-from time_chart.management.commands.config import (
-    DATE_FORMAT,
-    WEEKDAYS,
-    WEEKDAYS_SHORT
+from django.http import StreamingHttpResponse
+from django.shortcuts import redirect
+from django.urls import path, reverse
+from django.utils.html import format_html
+
+from time_chart.exports import (
+    REPORT_COLUMNS,
+    SCHEDULE_COLUMNS,
+    STREAM_CONTENT_TYPES,
+    attendance_rows,
+    report_users,
+    schedule_rows,
+    stream,
 )
-from time_chart.management.commands.tools import logger
-from time_chart.models import Group, Place, TimeSlot, User
-from time_chart.views import UserAutocomplete, DefineScheduleView
+from time_chart.management.commands.config import SCHEDULE_HORIZON_DAYS
+from time_chart.models import BroadcastJob, ExportJob, Group, Place, ScheduleTemplate, ScheduleVersion, TimeSlot, User
+from time_chart.pagination import KeysetChangeList
+from time_chart.schedule import materialize_templates
+from time_chart.views import UserAutocomplete, DefineScheduleView, ExportJobView
 
 
 class ScheduleAdmin(admin.AdminSite):
@@ -40,12 +43,28 @@ class ScheduleAdmin(admin.AdminSite):
                 self.admin_view(UserAutocomplete.as_view()),
                 name='user-autocomplete',
             ),
+            path('time_chart/exportjob/<int:pk>/status/',
+                 self.admin_view(ExportJobView.as_view()),
+                 name='export_job'),
         ]
         return new_urls + urls
 
 admin_site = ScheduleAdmin(name='scheduleadmin')
 
 
+def queue_export(kind, selection=None):
+    """Queue an export for the export_worker and open its status page"""
+    job = ExportJob.queue(kind, selection)
+    return redirect(reverse('scheduleadmin:export_job', args=[job.pk]))
+
+
+def stream_response(fmt, name, columns, rows):
+    """Stream the rows as a csv or ndjson attachment"""
+    response = StreamingHttpResponse(stream(fmt, columns, rows), content_type=STREAM_CONTENT_TYPES[fmt])
+    response['Content-Disposition'] = f'attachment; filename={name}.{fmt}'
+    return response
+
+
 class GroupForm(forms.ModelForm):
 
     class Meta:
@@ -63,85 +82,22 @@ class GroupAdmin(admin.ModelAdmin):
 
 class UserAdmin(admin.ModelAdmin):
     list_display = ('id', 'nick_name', 'first_name', 'last_name', 'is_active', 'group_name')
-    actions = ["get_user_report"]
+    list_select_related = ('group',)
+    actions = ["get_user_report", "export_report_csv", "export_report_ndjson"]
     list_filter = ('group_id',)
 
     def get_user_report(self, request, queryset):
-        response = HttpResponse(content_type='application/vnd.ms-excel')
-        response['Content-Disposition'] = 'attachment; filename=schedule.xlsx'
-        xlsx_data = self.make_report(queryset)
-        response.write(xlsx_data)
-        return response
-
-    def make_report(self, queryset, complete=False):
-
-        users = queryset.select_related().all()
-
-        groups = list(set([user.group.name for user in users]))
-        groups.sort()
-
-        output = io.BytesIO()
-        workbook = xlsxwriter.Workbook(output)
-
-        places = list(Place.objects.filter(is_active=True))
-        places_count = len(places)
-
-        slots=[]
-
-        for user in users:
-            slots += list(TimeSlot.objects.filter(people__id=user.id))
+        return queue_export(ExportJob.REPORT, list(queryset.values_list('pk', flat=True)))
 
-        dates = [slot.date for slot in slots]
-        weeks = [(date.isocalendar()[0], date.isocalendar()[1]) for date in dates]
-        weeks = list(set(weeks))
-        weeks.sort()
+    def export_report_csv(self, request, queryset):
+        return stream_response('csv', 'report', REPORT_COLUMNS, attendance_rows(report_users(queryset)))
 
-        worksheet = workbook.add_worksheet()
+    export_report_csv.short_description = "Export report of selected users as CSV"
 
-        date_format = workbook.add_format({
-            'align': 'center',
-            'bold': True,
-        })
+    def export_report_ndjson(self, request, queryset):
+        return stream_response('ndjson', 'report', REPORT_COLUMNS, attendance_rows(report_users(queryset)))
 
-        for user_index, user in enumerate(users):
-            worksheet.write(2 + user_index, 0, user.last_name)
-
-        for week_index, (year, week) in enumerate(weeks):
-
-            week_begin = dt.datetime.strptime(f'{year} {week} 1', '%Y %W %w')
-            week_end = dt.datetime.strptime(f'{year} {week} 0', '%Y %W %w')
-            week_header = f'{year} {week_begin.month}.{week_begin.day}-{week_end.month}.{week_end.day}'
-
-            if places_count == 1:
-                worksheet.write(0,  1 + week_index, week_header, date_format)
-            else:
-                worksheet.merge_range(
-                    0,
-                    1 + week_index * places_count,
-                    0,
-                    1 + week_index * places_count + (places_count - 1),
-                    week_header,
-                    date_format)
-
-            for place_index, place in enumerate(places):
-                worksheet.write(1,  1 + week_index * places_count + place_index, place.name)
-
-            for user_index, user in enumerate(users):
-
-                for place_index, place in enumerate(places):
-
-                    user_slots = list(TimeSlot.objects.filter(people__id=user.id, place_id=place.id).order_by('date'))
-
-                    days = []
-                    for slot_index, slot in enumerate(user_slots):
-                        if slot.date.isocalendar()[0] == year and slot.date.isocalendar()[1] == week :
-                            days.append(WEEKDAYS_SHORT[slot.date.weekday()])
-
-                    worksheet.write(2 + user_index, 1 + week_index * places_count + place_index, ', '.join(days))
-
-        workbook.close()
-
-        return output.getvalue()
+    export_report_ndjson.short_description = "Export report of selected users as NDJSON"
 
     def group_name(self, obj):
         if obj.group:
@@ -161,9 +117,15 @@ class TimeSlotForm(forms.ModelForm):
 
 class TimeSlotAdmin(admin.ModelAdmin):
     form = TimeSlotForm
-    actions = ["get_complete_schedule", "get_current_schedule", "mark_closed", "mark_open"]
-    ordering = ("place_id", "date", "time")
+    actions = ["get_complete_schedule", "get_current_schedule", "export_schedule_csv", "export_schedule_ndjson",
+               "mark_closed", "mark_open"]
+    ordering = ("date", "time", "place")
+    list_display = ('__str__', 'open', 'limit', 'people_count', 'free_seats', 'groups')
     list_filter = ('place_id',)
+    list_select_related = ('place',)
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
 
     def get_queryset(self, request):
         """
@@ -172,125 +134,108 @@ class TimeSlotAdmin(admin.ModelAdmin):
         """
         qs = super().get_queryset(request)
         qs = qs.filter(date__gte=dt.date.today())
+        qs = qs.with_free_seats().prefetch_related('allowed_groups')
         qs = qs.order_by('date', 'time', 'place')
         return qs
 
+    def people_count(self, obj):
+        return obj.people_count
+
+    people_count.admin_order_field = 'people_count'
+
+    def free_seats(self, obj):
+        return obj.free_seats
+
+    free_seats.admin_order_field = 'free_seats'
+
+    def groups(self, obj):
+        return ', '.join(group.name for group in obj.allowed_groups.all())
+
     def mark_open(modeladmin, request, queryset):
         queryset.update(open=True)
+        ScheduleVersion.bump()
 
     def mark_closed(modeladmin, request, queryset):
         queryset.update(open=False)
+        ScheduleVersion.bump()
 
     def get_current_schedule(self, request, queryset):
-        response = HttpResponse(content_type='application/vnd.ms-excel')
-        response['Content-Disposition'] = 'attachment; filename=schedule.xlsx'
-        xlsx_data = self.make_schedule(queryset)
-        response.write(xlsx_data)
-        return response
+        return queue_export(ExportJob.SCHEDULE, list(queryset.values_list('pk', flat=True)))
 
     get_current_schedule.short_description = "Export Selected time slots as Schedule"
 
     def get_complete_schedule(self, request, queryset):
-        response = HttpResponse(content_type='application/vnd.ms-excel')
-        response['Content-Disposition'] = 'attachment; filename=schedule.xlsx'
-        xlsx_data = self.make_schedule(queryset, complete=True)
-        response.write(xlsx_data)
-        return response
+        return queue_export(ExportJob.SCHEDULE)
 
     get_complete_schedule.short_description = "Export Complete Schedule"
 
-    def make_schedule(self, queryset, complete=False):
-        add_count = True
-
-        if complete:
-            qs = TimeSlot.objects.select_related().all()
-        else:
-            qs = queryset.select_related().all()
-
-        times = list(set([time_slot.time.strftime('%H:%M') for time_slot in qs]))
-        times.sort()
-
-        people = set([u for t in qs for u in t.people.all()])
-
-        column_width = max([len(str(p.group)) + len(p.last_name) + 4 for p in people])
-
-        user_count = User.objects.filter(
-            id__in=[p.id for p in people],
-            timeslot__date__lt=dt.date.today()
-        ).annotate(time_slot_count=Count('timeslot'))
-        user_count = dict({u.id: u.time_slot_count for u in user_count})
-        lines = [(line.place.name, line.date.isoformat(), line.time.strftime('%H:%M'),
-                  str(u.group), u.last_name,
-                  str(user_count.get(u.id, 0)),  # visit count
-                  u.group.color)
-                 for line in qs for u in line.people.all()]
-        # partition by places
-        records_by_date_place = defaultdict(list)
-        for line in lines:
-            # group by date+place
-            records_by_date_place[(line[1], line[0])].append(line)
-        output = io.BytesIO()
-        workbook = xlsxwriter.Workbook(output)
-        try:
-            merge_format = workbook.add_format({
-                'align': 'center',
-                'bold': True,
-            })
-            merge_format.set_border()
-
-            worksheet = workbook.add_worksheet()
-            row = 0
-            for key in sorted(records_by_date_place.keys()):
-                records = records_by_date_place[key]
-                row += 1
-                # merge cells and write 'day date place'
-                date = dt.datetime.strptime(key[0], DATE_FORMAT).date()
-                day = WEEKDAYS[date.weekday()]
-                place = key[1]
-                worksheet.merge_range(row, 1, row, len(times), f'{day}, {date.strftime("%d-%m-%Y")}, {place}', merge_format)
-                worksheet.set_column(1, len(times), column_width)
-                row += 1
-                # write time slots
-                col = 1
-                for time in times:
-                    cell_format = workbook.add_format()
-                    cell_format.set_bold()
-                    cell_format.set_border()
-                    worksheet.write(row, col, time, cell_format)
-                    # logger.debug("writing classes row")
-                    col += 1
-                row += 1
-                students_lists = defaultdict(list)
-                for line in sorted(records, key=lambda x: (x[3], x[4]) or ('', '')):  # sort by (group, last name)
-                    string = f"{line[3]} {line[4]} ({line[5]})" if add_count else f"{line[3]} {line[4]}"
-                    students_lists[line[2]].append((string, line[6]))  # append cell text and bg color
-                lines = []
-                for time in times:
-                    lines.append(students_lists[time])
-                for line in zip_longest(*lines, fillvalue=("", "")):
-                    col = 1
-                    for val, color in line:
-                        if color:
-                            cell_format = workbook.add_format()
-                            cell_format.set_bg_color(color)
-                            cell_format.set_border()
-                            worksheet.write(row, col, val, cell_format)
-                        else:
-                            cell_format = workbook.add_format()
-                            cell_format.set_border()
-                            worksheet.write(row, col, val, cell_format)
-                        # logger.debug("writing data row")
-                        col += 1
-                    row += 1
-        except Exception as e:
-            logger.error(e)
-        finally:
-            workbook.close()
-
-        return output.getvalue()
+    def export_schedule_csv(self, request, queryset):
+        return stream_response('csv', 'schedule', SCHEDULE_COLUMNS, schedule_rows(queryset))
+
+    export_schedule_csv.short_description = "Export Selected time slots as CSV"
+
+    def export_schedule_ndjson(self, request, queryset):
+        return stream_response('ndjson', 'schedule', SCHEDULE_COLUMNS, schedule_rows(queryset))
+
+    export_schedule_ndjson.short_description = "Export Selected time slots as NDJSON"
+
+
+class ScheduleTemplateAdmin(admin.ModelAdmin):
+    list_display = ('place', 'weekday', 'time', 'limit', 'open', 'valid_from', 'valid_until', 'is_active',
+                    'materialized_until')
+    list_filter = ('place_id', 'weekday', 'is_active')
+    ordering = ('place', 'weekday', 'time')
+    filter_horizontal = ('groups',)
+    actions = ["materialize"]
+
+    def materialize(self, request, queryset):
+        end = dt.date.today() + dt.timedelta(days=SCHEDULE_HORIZON_DAYS)
+        created = materialize_templates(queryset, end)
+        self.message_user(request, f"{created} TimeSlots are created up to {end}")
+
+    materialize.short_description = "Create time slots of selected templates"
+
+
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'status', 'created', 'finished', 'status_page')
+    list_filter = ('kind', 'status')
+    exclude = ('selection',)
+    readonly_fields = ('kind', 'status', 'created', 'started', 'finished', 'size', 'error')
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).defer('selection')
+
+    def has_add_permission(self, request):
+        return False
+
+    def status_page(self, obj):
+        url = reverse('scheduleadmin:export_job', args=[obj.pk])
+        return format_html('<a href="{}">{}</a>', url, 'download' if obj.status == ExportJob.DONE else 'status')
+
+
+class BroadcastJobAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'status', 'created', 'finished', 'recipients', 'sent', 'failed_count')
+    list_filter = ('status',)
+    exclude = ('chat_ids',)
+    readonly_fields = ('text', 'status', 'created', 'started', 'finished',
+                       'recipients', 'sent', 'failed', 'retries', 'elapsed', 'error')
+
+    def has_add_permission(self, request):
+        return False
+
+    def recipients(self, obj):
+        return len(obj.chat_ids)
+
+    def failed_count(self, obj):
+        return len(obj.failed) if obj.failed is not None else None
+
+    failed_count.short_description = 'failed'
 
 
 admin_site.register(Group, GroupAdmin)
 admin_site.register(User, UserAdmin)
 admin_site.register(Place)
 admin_site.register(TimeSlot, TimeSlotAdmin)
+admin_site.register(ScheduleTemplate, ScheduleTemplateAdmin)
+admin_site.register(ExportJob, ExportJobAdmin)
+admin_site.register(BroadcastJob, BroadcastJobAdmin)
@@ -0,0 +1,88 @@
+"""Read-only JSON API of the open time slots for the web calendar
+
+``/api/places/`` lists the active places, ``/api/availability/`` the open
+time slots with free seats from tomorrow on (the days the bot offers),
+optionally of a ``place`` and a ``group`` (names, as in the bot) and a
+``date`` (YYYY-MM-DD).
+
+Every change of the schedule bumps ``ScheduleVersion``, so the ETag of an
+answer is derived from it, the date and the query string. A request with a
+matching ``If-None-Match`` is answered with 304 after one query, and the
+answers may be cached by browsers and CDNs for API_CACHE_MAX_AGE seconds.
+Errors get neither an ETag nor the public caching, they must not be stored.
+"""
+import datetime as dt
+import hashlib
+from functools import wraps
+
+from django.http import JsonResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+from django.views.decorators.http import require_safe
+
+from time_chart.management.commands.config import API_CACHE_MAX_AGE
+from time_chart.models import Group, Place, ScheduleVersion, TimeSlot
+
+
+def schedule_etag(request, *args, **kwargs):
+    key = f'{request.path}:{ScheduleVersion.current()}:{dt.date.today()}:{request.GET.urlencode()}'
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def cached_by_schedule(view):
+    """ETag and public caching for the answers of the view, no-store for its errors"""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        etag = quote_etag(schedule_etag(request))
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = view(request, *args, **kwargs)
+            if response.status_code != 200:
+                patch_cache_control(response, no_store=True)
+                return response
+        response['ETag'] = etag
+        patch_cache_control(response, public=True, max_age=API_CACHE_MAX_AGE)
+        return response
+    return wrapper
+
+
+def error(message):
+    return JsonResponse({'error': message}, status=400)
+
+
+@require_safe
+@cached_by_schedule
+def places(request):
+    names = Place.objects.filter(is_active=True).order_by('name').values_list('name', flat=True)
+    return JsonResponse({'places': list(names)}, json_dumps_params={'ensure_ascii': False})
+
+
+@require_safe
+@cached_by_schedule
+def availability(request):
+    slots = TimeSlot.objects.filter(open=True, date__gt=dt.date.today(), place__is_active=True)
+    if request.GET.get('place'):
+        slots = slots.filter(place__name=request.GET['place'])
+    if request.GET.get('date'):
+        try:
+            slots = slots.filter(date=dt.date.fromisoformat(request.GET['date']))
+        except ValueError:
+            return error('date must be YYYY-MM-DD')
+    if request.GET.get('group'):
+        group_id = Group.objects.filter(name=request.GET['group'], is_active=True).values_list('pk', flat=True).first()
+        if group_id is None:
+            return error('unknown group')
+        slots = slots.for_group(group_id)
+    slots = slots.with_free_seats().filter(free_seats__gt=0).select_related('place').prefetch_related(
+        'allowed_groups').order_by('date', 'time', 'place__name')
+
+    return JsonResponse({'slots': [{
+        'id': slot.pk,
+        'place': slot.place.name,
+        'date': slot.date.isoformat(),
+        'time': slot.time.strftime('%H:%M'),
+        'limit': slot.limit,
+        'free_seats': slot.free_seats,
+        # no groups means open to every group
+        'groups': sorted(group.name for group in slot.allowed_groups.all()),
+    } for slot in slots]}, json_dumps_params={'ensure_ascii': False})
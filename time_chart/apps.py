@@ -6,3 +6,7 @@ class TimeChartAdminConfig(SimpleAdminConfig):
     name = 'time_chart'
     verbose_name = 'Time Chart Bot'
     default_site = 'time_chart.admin.ScheduleAdmin'
+
+    def ready(self):
+        super().ready()
+        from time_chart import signals  # noqa: F401
@@ -0,0 +1,54 @@
+"""Moving of the past time slots into the archive tables
+
+The bot and the admin only read the time slots from today on, so the old
+slots and their bookings are moved into ``ArchivedTimeSlot`` and
+``ArchivedBooking``, which keeps the hot tables and their indexes small.
+The user report reads both (``all_bookings``), the visit counts come from
+the ``Attendance`` counters and do not change. The allowed groups of the
+archived slots are dropped.
+
+The slots are deleted inside ``signals.archiving``, so the bookings are not
+uncounted from the booking counters.
+"""
+from django.db import transaction
+
+from time_chart import signals
+from time_chart.management.commands.config import ARCHIVE_BATCH_SIZE
+from time_chart.models import ArchivedBooking, ArchivedTimeSlot, ScheduleVersion, TimeSlot
+
+
+def archive_batch(before, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move the oldest time slots dated before ``before`` and their bookings
+    into the archive in one transaction, returns the numbers of moved slots
+    and bookings"""
+    people = TimeSlot.people.through
+    with transaction.atomic():
+        slots = list(TimeSlot.objects.select_for_update().filter(date__lt=before).order_by(
+            'date', 'id').values_list('pk', 'place_id', 'date', 'time')[:batch_size])
+        if not slots:
+            return 0, 0
+        pks = [pk for pk, _, _, _ in slots]
+        ArchivedTimeSlot.objects.bulk_create(
+            [ArchivedTimeSlot(id=pk, place_id=place_id, date=date, time=time) for pk, place_id, date, time in slots])
+        bookings = ArchivedBooking.objects.bulk_create(
+            [ArchivedBooking(timeslot_id=timeslot_id, user_id=user_id) for timeslot_id, user_id in
+             people.objects.filter(timeslot_id__in=pks).values_list('timeslot_id', 'user_id')],
+            batch_size=batch_size)
+        people.objects.filter(timeslot_id__in=pks).delete()
+        TimeSlot.allowed_groups.through.objects.filter(timeslot_id__in=pks).delete()
+        with signals.archiving():
+            TimeSlot.objects.filter(pk__in=pks).delete()
+        transaction.on_commit(ScheduleVersion.bump)
+    return len(slots), len(bookings)
+
+
+def archive_time_slots(before, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move all the time slots dated before ``before`` into the archive, a
+    transaction per batch, returns the numbers of moved slots and bookings"""
+    total_slots = total_bookings = 0
+    while True:
+        slots, bookings = archive_batch(before, batch_size)
+        if not slots:
+            return total_slots, total_bookings
+        total_slots += slots
+        total_bookings += bookings
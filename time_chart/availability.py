@@ -0,0 +1,112 @@
+"""In-process index of free seats in the open time slots
+
+The sign up conversation asks for the available dates and times on every
+step. Instead of aggregating the people m2m table each time, the bot keeps
+the open future slots of a place in memory together with the number of
+taken seats and the allowed groups. The index is kept up to date by the
+model signals (see ``time_chart.signals``). Changes done by other processes
+(e.g. the admin site) do not reach the bot signals, so every place is also
+reloaded from the database once its entries are older than ``ttl`` seconds.
+The index only drives the keyboards, ``TimeSlot.reserve`` remains the source
+of truth for the booking itself.
+"""
+import datetime as dt
+import threading
+import time
+from collections import defaultdict, namedtuple
+
+from time_chart.management.commands.config import AVAILABILITY_INDEX_TTL
+from time_chart.models import TimeSlot
+
+SlotEntry = namedtuple('SlotEntry', 'pk place date time limit taken groups')
+
+
+class AvailabilityIndex:
+
+    def __init__(self, ttl=AVAILABILITY_INDEX_TTL):
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._slots = {}  # slot pk -> SlotEntry
+        self._places = defaultdict(set)  # place name -> slot pks
+        self._loaded_at = {}  # place name -> load time
+
+    def dates(self, place, group_id, after):
+        """Sorted dates later than ``after`` with a free seat for the group"""
+        dates = set(entry.date for entry in self._available(place, group_id) if entry.date > after)
+        return sorted(dates)
+
+    def times(self, place, date, group_id):
+        """``(slot pk, time, free seats)`` of the free slots for the group sorted by time"""
+        rows = [(entry.pk, entry.time, entry.limit - entry.taken)
+                for entry in self._available(place, group_id) if entry.date == date]
+        return sorted(rows, key=lambda row: row[1])
+
+    def add_people(self, slot_pk, count):
+        with self._lock:
+            entry = self._slots.get(slot_pk)
+            if entry is not None:
+                self._slots[slot_pk] = entry._replace(taken=entry.taken + count)
+
+    def refresh(self, slot_pks):
+        """Reload the given slots from the database"""
+        slot_pks = set(slot_pks)
+        with self._lock:
+            for pk in slot_pks:
+                self._discard(pk)
+            loaded = list(self._loaded_at)
+        if not loaded or not slot_pks:
+            return
+        self._store(self._query(pk__in=slot_pks, place__name__in=loaded))
+
+    def discard(self, slot_pk):
+        with self._lock:
+            self._discard(slot_pk)
+
+    def clear(self):
+        with self._lock:
+            self._slots.clear()
+            self._places.clear()
+            self._loaded_at.clear()
+
+    def _available(self, place, group_id):
+        self._ensure_loaded(place)
+        with self._lock:
+            entries = [self._slots[pk] for pk in self._places.get(place, ())]
+        return [entry for entry in entries
+                if entry.taken < entry.limit and (not entry.groups or group_id in entry.groups)]
+
+    def _ensure_loaded(self, place):
+        loaded_at = self._loaded_at.get(place)
+        if loaded_at is not None and time.monotonic() - loaded_at < self.ttl:
+            return
+        entries = self._query(place__name=place)
+        with self._lock:
+            for pk in list(self._places.get(place, ())):
+                self._discard(pk)
+            self._loaded_at[place] = time.monotonic()
+        self._store(entries)
+
+    def _query(self, **filters):
+        qs = TimeSlot.objects.filter(open=True, date__gte=dt.date.today(), **filters)
+        rows = qs.with_free_seats().values_list(
+            'pk', 'place__name', 'date', 'time', 'limit', 'people_count')
+        groups = defaultdict(set)
+        for slot_pk, group_pk in TimeSlot.allowed_groups.through.objects.filter(
+                timeslot__in=qs).values_list('timeslot_id', 'group_id'):
+            groups[slot_pk].add(group_pk)
+        return [SlotEntry(*row, groups=frozenset(groups[row[0]])) for row in rows]
+
+    def _store(self, entries):
+        with self._lock:
+            for entry in entries:
+                if entry.place in self._loaded_at:
+                    self._slots[entry.pk] = entry
+                    self._places[entry.place].add(entry.pk)
+
+    def _discard(self, slot_pk):
+        entry = self._slots.pop(slot_pk, None)
+        if entry is not None:
+            self._places[entry.place].discard(slot_pk)
+
+
+index = AvailabilityIndex()
@@ -0,0 +1,137 @@
+"""Delivery of one bot message to many chats
+
+Messages are sent concurrently (at most ``concurrency`` requests in flight)
+while a token bucket shared by all of them keeps the bot under the Telegram
+limit of about 30 messages per second. A chat answered with 429 waits for
+``retry_after`` and pauses the bucket for everybody, network errors and 5xx
+answers are retried with exponential backoff, other errors (e.g. the user
+blocked the bot) are final. The outcome is collected in a DeliveryReport.
+
+The messages are queued as ``BroadcastJob`` rows and sent by the
+``broadcast_worker`` command (see ``run_broadcast_job``).
+"""
+import asyncio
+import time
+from dataclasses import dataclass, field
+
+import aiohttp
+from django.utils import timezone
+
+from time_chart.management.commands.config import (
+    BOT_TOKEN,
+    BROADCAST_CONCURRENCY,
+    BROADCAST_RATE,
+    BROADCAST_RETRIES,
+    BROADCAST_TIMEOUT,
+)
+from time_chart.management.commands.tools import logger
+from time_chart.models import BroadcastJob
+
+SEND_MESSAGE_URL = 'https://api.telegram.org/bot{token}/sendMessage'
+BACKOFF_BASE = 1
+
+
+class TokenBucket:
+    """Lets through ``rate`` acquisitions per second on average"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Hold back all acquisitions for about ``seconds``"""
+        self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+
+@dataclass
+class DeliveryReport:
+    sent: list = field(default_factory=list)
+    failed: dict = field(default_factory=dict)  # chat id -> last error
+    retries: int = 0
+    elapsed: float = 0
+
+    def __str__(self):
+        return (f'sent {len(self.sent)}, failed {len(self.failed)}, '
+                f'retries {self.retries}, {self.elapsed:.1f}s')
+
+
+async def _send(session, bucket, semaphore, report, chat_id, text, retries):
+    url = SEND_MESSAGE_URL.format(token=BOT_TOKEN)
+    error = None
+    async with semaphore:
+        for attempt in range(retries + 1):
+            if attempt:
+                report.retries += 1
+            await bucket.acquire()
+            try:
+                async with session.post(url, data={'chat_id': chat_id, 'text': text}) as response:
+                    body = await response.json(content_type=None)
+                    status = response.status
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                error = repr(e)
+                delay = BACKOFF_BASE * 2 ** attempt
+            else:
+                if body.get('ok'):
+                    report.sent.append(chat_id)
+                    return
+                error = body.get('description', f'HTTP {status}')
+                if status == 429:
+                    delay = (body.get('parameters') or {}).get('retry_after', BACKOFF_BASE * 2 ** attempt)
+                    bucket.pause(delay)
+                elif status >= 500:
+                    delay = BACKOFF_BASE * 2 ** attempt
+                else:
+                    break
+            if attempt < retries:
+                await asyncio.sleep(delay)
+    report.failed[chat_id] = error
+
+
+async def _broadcast(chat_ids, text, concurrency, rate, timeout, retries):
+    report = DeliveryReport()
+    started = time.monotonic()
+    bucket = TokenBucket(rate)
+    semaphore = asyncio.Semaphore(concurrency)
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        await asyncio.gather(*(_send(session, bucket, semaphore, report, chat_id, text, retries)
+                               for chat_id in chat_ids))
+    report.elapsed = time.monotonic() - started
+    return report
+
+
+def broadcast(chat_ids, text,
+              concurrency=BROADCAST_CONCURRENCY,
+              rate=BROADCAST_RATE,
+              timeout=BROADCAST_TIMEOUT,
+              retries=BROADCAST_RETRIES):
+    """Send ``text`` to every chat, returns a DeliveryReport"""
+    return asyncio.run(_broadcast(list(chat_ids), text, concurrency, rate, timeout, retries))
+
+
+def run_broadcast_job(job):
+    """Send the message of a claimed job and store its DeliveryReport"""
+    try:
+        report = broadcast(job.chat_ids, job.text)
+    except Exception as e:
+        logger.exception('Broadcast job %s failed', job.pk)
+        BroadcastJob.objects.filter(pk=job.pk).update(
+            status=BroadcastJob.FAILED, error=repr(e), finished=timezone.now())
+        return None
+    BroadcastJob.objects.filter(pk=job.pk).update(
+        status=BroadcastJob.DONE, sent=len(report.sent), failed=report.failed,
+        retries=report.retries, elapsed=report.elapsed, finished=timezone.now())
+    return report
@@ -0,0 +1,334 @@
+"""Data loading and rendering of the admin exports
+
+The rows of the user report come from ``attendance_rows``, which reads the
+bookings and the archived bookings of the users with one query per chunk of
+users. They are streamed as CSV or NDJSON as they are, the XLSX writer needs
+all weeks for its header first and pivots them with ``AttendancePivot``.
+
+The schedule is streamed: the bookings are read with one flat query in
+chunks of ``EXPORT_CHUNK_SIZE`` rows and written block by block. XLSX files
+are written in xlsxwriter ``constant_memory`` mode (rows strictly in order)
+into a temporary file, so the memory use does not grow with the number of
+rows.
+
+The schedule is also streamed as CSV or NDJSON (``stream``), row by row in
+constant memory, for the analytics dumps.
+
+The admin does not build the XLSX files in the web request, it queues an
+``ExportJob`` and the ``export_worker`` command runs it with
+``run_export_job``.
+"""
+import csv
+import datetime as dt
+import json
+import tempfile
+from collections import defaultdict
+from itertools import groupby, islice, zip_longest
+
+import xlsxwriter
+from django.db import transaction
+from django.utils import timezone
+
+from time_chart.management.commands.config import (
+    EXPORT_CHUNK_SIZE,
+    EXPORT_FILE_PART_SIZE,
+    WEEKDAYS,
+    WEEKDAYS_SHORT,
+)
+from time_chart.management.commands.tools import logger
+from time_chart.models import Attendance, ExportFilePart, ExportJob, Place, TimeSlot, User, all_bookings
+
+
+class FormatPool:
+    """One xlsxwriter Format per distinct style of a workbook
+
+    ``add_format`` creates a new object on every call and the workbook dedupes
+    them only when it is closed, so the exporters ask the pool instead.
+    """
+
+    def __init__(self, workbook):
+        self.workbook = workbook
+        self._formats = {}
+
+    def get(self, bold=False, border=False, bg_color=None, align=None):
+        key = (bold, border, bg_color, align)
+        cell_format = self._formats.get(key)
+        if cell_format is None:
+            cell_format = self._formats[key] = self.add(*key)
+        return cell_format
+
+    def add(self, bold, border, bg_color, align):
+        properties = {'bold': bold, 'border': int(border), 'bg_color': bg_color, 'align': align}
+        return self.workbook.add_format({k: v for k, v in properties.items() if v})
+
+
+REPORT_COLUMNS = ('user_id', 'last_name', 'year', 'week', 'place', 'days')
+
+
+def report_users(queryset):
+    """The users of a report in the order of its rows"""
+    return queryset.order_by('last_name', 'first_name')
+
+
+def attendance_rows(users_queryset):
+    """``REPORT_COLUMNS`` of every user, week and place with bookings
+
+    The users come in the queryset order, each with its weeks in order, the
+    bookings are read for EXPORT_CHUNK_SIZE users at a time.
+    """
+    places = list(Place.objects.filter(is_active=True).values_list('id', 'name'))
+    users = iter(users_queryset.values_list('id', 'last_name'))
+    while True:
+        chunk = list(islice(users, EXPORT_CHUNK_SIZE))
+        if not chunk:
+            return
+        days = defaultdict(lambda: defaultdict(list))  # user id -> (year, week, place id) -> weekdays
+        bookings = all_bookings(
+            ('user_id', 'timeslot__date', 'timeslot__place_id'), user_id__in=[user_id for user_id, _ in chunk],
+        ).order_by('timeslot__date')
+        for user_id, date, place_id in bookings:
+            year, week, weekday = date.isocalendar()
+            days[user_id][(year, week, place_id)].append(WEEKDAYS_SHORT[weekday - 1])
+        for user_id, last_name in chunk:
+            user_days = days.get(user_id, {})
+            for year, week in sorted(set(key[:2] for key in user_days)):
+                for place_id, place_name in places:
+                    if (year, week, place_id) in user_days:
+                        yield user_id, last_name, year, week, place_name, ', '.join(user_days[(year, week, place_id)])
+
+
+class AttendancePivot:
+    """``attendance_rows`` as (user, week, place) -> weekdays
+
+    ``users`` are ``(id, last_name)`` in the queryset order, ``weeks`` the
+    sorted ``(iso year, iso week)`` with any booking of the users and
+    ``places`` the active places.
+    """
+
+    def __init__(self, users_queryset):
+        self.users = list(users_queryset.values_list('id', 'last_name'))
+        self.places = list(Place.objects.filter(is_active=True).values_list('id', 'name'))
+        self._days = {}
+        weeks = set()
+        for user_id, _, year, week, place_name, days in attendance_rows(users_queryset):
+            weeks.add((year, week))
+            self._days[(user_id, (year, week), place_name)] = days
+        self.weeks = sorted(weeks)
+
+    def days(self, user_id, week, place_name):
+        """Short weekday names of the user bookings sorted by date"""
+        return self._days.get((user_id, week, place_name), '')
+
+
+def week_header(year, week):
+    week_begin = dt.datetime.strptime(f'{year} {week} 1', '%Y %W %w')
+    week_end = dt.datetime.strptime(f'{year} {week} 0', '%Y %W %w')
+    return f'{year} {week_begin.month}.{week_begin.day}-{week_end.month}.{week_end.day}'
+
+
+class XlsxReportWriter:
+    """Users in rows, a column per week and place"""
+
+    def __init__(self, output):
+        self.output = output
+
+    def write(self, pivot):
+        workbook = xlsxwriter.Workbook(self.output, {'constant_memory': True})
+        worksheet = workbook.add_worksheet()
+        date_format = FormatPool(workbook).get(bold=True, align='center')
+        places_count = len(pivot.places)
+
+        for week_index, (year, week) in enumerate(pivot.weeks):
+            header = week_header(year, week)
+            if places_count == 1:
+                worksheet.write(0, 1 + week_index, header, date_format)
+            else:
+                worksheet.merge_range(
+                    0,
+                    1 + week_index * places_count,
+                    0,
+                    1 + week_index * places_count + (places_count - 1),
+                    header,
+                    date_format)
+        # constant_memory mode flushes a row once the next one is written
+        for week_index in range(len(pivot.weeks)):
+            for place_index, (_, place_name) in enumerate(pivot.places):
+                worksheet.write(1, 1 + week_index * places_count + place_index, place_name)
+
+        for user_index, (user_id, last_name) in enumerate(pivot.users):
+            worksheet.write(2 + user_index, 0, last_name)
+            for week_index, week in enumerate(pivot.weeks):
+                for place_index, (_, place_name) in enumerate(pivot.places):
+                    worksheet.write(2 + user_index, 1 + week_index * places_count + place_index,
+                                    pivot.days(user_id, week, place_name))
+
+        workbook.close()
+
+
+def report_xlsx(users_queryset):
+    """User report rendered into a rewound temporary file"""
+    output = tempfile.TemporaryFile()
+    XlsxReportWriter(output).write(AttendancePivot(users_queryset))
+    output.seek(0)
+    return output
+
+
+# *********** Schedule ***************************
+
+def visit_counts(queryset):
+    """Number of past classes of every user booked into the time slots"""
+    return Attendance.visits_of(TimeSlot.people.through.objects.filter(timeslot__in=queryset).values('user_id'))
+
+
+def schedule_records(queryset, visits):
+    """``(place, date, time, group, last name, visits, color, user id)`` of every booking
+
+    One flat query over the people through table joined to the time slot,
+    place, user and group, ordered by date and place and read in chunks.
+    The group is None for the users without a group.
+    """
+    rows = TimeSlot.people.through.objects.filter(timeslot__in=queryset).order_by(
+        'timeslot__date', 'timeslot__place__name', 'timeslot__time', 'id',
+    ).values_list(
+        'timeslot__place__name', 'timeslot__date', 'timeslot__time',
+        'user__group__name', 'user__last_name', 'user_id', 'user__group__color',
+    )
+    for place, date, time, group, last_name, user_id, color in rows.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        yield (place, date.isoformat(), time.strftime('%H:%M'),
+               group, last_name,
+               visits.get(user_id, 0),
+               color if group is not None else '',
+               user_id)
+
+
+def schedule_xlsx(queryset, add_count=True):
+    """Schedule of the time slots rendered into a rewound temporary file
+
+    Every date and place gets a block with a column per class time listing
+    the booked people.
+    """
+    times = sorted(set(t.strftime('%H:%M') for t in queryset.order_by().values_list('time', flat=True).distinct()))
+    visits = visit_counts(queryset)
+
+    output = tempfile.TemporaryFile()
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+    formats = FormatPool(workbook)
+    try:
+        merge_format = formats.get(bold=True, border=True, align='center')
+        time_format = formats.get(bold=True, border=True)
+
+        worksheet = workbook.add_worksheet()
+        column_width = 0
+        row = 0
+        for (date, place), records in groupby(schedule_records(queryset, visits), key=lambda r: (r[1], r[0])):
+            records = list(records)
+            column_width = max([column_width] + [len(str(r[3])) + len(r[4]) + 4 for r in records])
+            row += 1
+            # merge cells and write 'day date place'
+            date = dt.date.fromisoformat(date)
+            day = WEEKDAYS[date.weekday()]
+            worksheet.merge_range(row, 1, row, len(times), f'{day}, {date.strftime("%d-%m-%Y")}, {place}', merge_format)
+            row += 1
+            # write time slots
+            col = 1
+            for time in times:
+                worksheet.write(row, col, time, time_format)
+                col += 1
+            row += 1
+            students_lists = defaultdict(list)
+            for record in sorted(records, key=lambda x: (str(x[3]), x[4])):  # sort by (group, last name)
+                string = f"{record[3]} {record[4]} ({record[5]})" if add_count else f"{record[3]} {record[4]}"
+                students_lists[record[2]].append((string, record[6]))  # append cell text and bg color
+            for line in zip_longest(*[students_lists[time] for time in times], fillvalue=("", "")):
+                col = 1
+                for val, color in line:
+                    worksheet.write(row, col, val, formats.get(border=True, bg_color=color or None))
+                    col += 1
+                row += 1
+        if column_width:
+            worksheet.set_column(1, len(times), column_width)
+    except Exception as e:
+        logger.error(e)
+    finally:
+        workbook.close()
+
+    output.seek(0)
+    return output
+
+
+# *********** CSV and NDJSON streams ***************************
+
+SCHEDULE_COLUMNS = ('date', 'time', 'place', 'user_id', 'last_name', 'group', 'visits')
+
+STREAM_CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def schedule_rows(queryset):
+    """``SCHEDULE_COLUMNS`` of every booking of the time slots"""
+    for place, date, time, group, last_name, visits, _, user_id in schedule_records(queryset, visit_counts(queryset)):
+        yield date, time, place, user_id, last_name, group or '', visits
+
+
+class _Echo:
+    """File-like object returning what is written, for ``csv.writer``"""
+
+    def write(self, value):
+        return value
+
+
+def _csv_lines(columns, rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(columns)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def _ndjson_lines(columns, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n'
+
+
+def stream(fmt, columns, rows):
+    """Text of the rows as ``csv`` or ``ndjson`` in blocks of EXPORT_CHUNK_SIZE lines"""
+    lines = {'csv': _csv_lines, 'ndjson': _ndjson_lines}[fmt](columns, rows)
+    while True:
+        block = ''.join(islice(lines, EXPORT_CHUNK_SIZE))
+        if not block:
+            return
+        yield block
+
+
+# *********** Jobs ***************************
+
+def build_export(kind, selection):
+    """XLSX of an ``ExportJob`` kind and selection as a rewound temporary file"""
+    if kind == ExportJob.SCHEDULE:
+        queryset = TimeSlot.objects.all()
+        if selection is not None:
+            queryset = queryset.filter(pk__in=selection)
+        return schedule_xlsx(queryset)
+    if kind == ExportJob.REPORT:
+        return report_xlsx(report_users(User.objects.filter(pk__in=selection)))
+    raise ValueError(f'Unknown export {kind}')
+
+
+def run_export_job(job):
+    """Build the file of a claimed job and store it part by part"""
+    try:
+        with build_export(job.kind, job.selection) as output, transaction.atomic():
+            # parts left by a worker that died while storing the file
+            ExportFilePart.objects.filter(job=job).delete()
+            size = 0
+            for index, data in enumerate(iter(lambda: output.read(EXPORT_FILE_PART_SIZE), b'')):
+                ExportFilePart.objects.create(job=job, index=index, data=data)
+                size += len(data)
+            ExportJob.objects.filter(pk=job.pk).update(status=ExportJob.DONE, size=size, finished=timezone.now())
+    except Exception as e:
+        logger.exception('Export job %s failed', job.pk)
+        ExportJob.objects.filter(pk=job.pk).update(
+            status=ExportJob.FAILED, error=repr(e), finished=timezone.now())
+        return False
+    return True
@@ -0,0 +1,27 @@
+"""Moves the old time slots and their bookings into the archive tables
+
+Run it nightly or weekly. Every batch of slots
+is moved in its own transaction, so the command can be stopped and run
+again at any time.
+"""
+import datetime as dt
+
+from django.core.management.base import BaseCommand, CommandError
+
+from time_chart.archive import archive_time_slots
+from time_chart.management.commands.config import ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Move the time slots older than --days days into the archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=ARCHIVE_AFTER_DAYS, help='Age of the archived slots')
+        parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE, help='Slots moved per transaction')
+
+    def handle(self, *args, **options):
+        if options['days'] < 1:
+            raise CommandError('Only the past time slots can be archived, --days must be at least 1')
+        before = dt.date.today() - dt.timedelta(days=options['days'])
+        slots, bookings = archive_time_slots(before, options['batch_size'])
+        self.stdout.write(f'{slots} time slots and {bookings} bookings before {before} archived')
@@ -0,0 +1,81 @@
+"""Time and memory of the admin XLSX exports
+
+Seeds the same synthetic schedule as bench_queries, builds the complete
+schedule and the user report of all the synthetic users and prints the build
+time, the peak of the Python memory allocations and the file size of every
+export. Every export is also built with a new cell format per cell, as before
+``FormatPool``, for comparison. The data is rolled back, unless --keep is given.
+"""
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from time_chart import exports
+from time_chart.exports import FormatPool, report_xlsx, schedule_xlsx
+from time_chart.management.commands.bench_queries import USER_ID_OFFSET, Command as QueriesCommand, Rollback
+from time_chart.models import TimeSlot, User
+
+
+class UnpooledFormats(FormatPool):
+    """Adds a new format to the workbook on every call, the baseline"""
+
+    def get(self, bold=False, border=False, bg_color=None, align=None):
+        return self.add(bold, border, bg_color, align)
+
+
+@contextmanager
+def unpooled_formats():
+    pool = exports.FormatPool
+    exports.FormatPool = UnpooledFormats
+    try:
+        yield
+    finally:
+        exports.FormatPool = pool
+
+
+class Command(BaseCommand):
+    help = 'Seed a synthetic schedule and print build time and memory of the XLSX exports'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--days', type=int, default=90, help='Days of schedule, half of them in the past')
+        parser.add_argument('--places', type=int, default=3)
+        parser.add_argument('--repeat', type=int, default=3, help='Builds of every export')
+        parser.add_argument('--keep', action='store_true', help='Keep the synthetic data')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'Database: {connection.vendor}')
+        seeder = QueriesCommand(stdout=self.stdout, stderr=self.stderr)
+        try:
+            with transaction.atomic():
+                seeder.seed(options['users'], options['days'], options['places'])
+                builds = [
+                    ('schedule', lambda: schedule_xlsx(TimeSlot.objects.all())),
+                    ('user report', lambda: report_xlsx(User.objects.filter(id__gte=USER_ID_OFFSET).order_by('id'))),
+                ]
+                for name, build in builds:
+                    self.report(name, build, options['repeat'])
+                    with unpooled_formats():
+                        self.report(f'{name}, a format per cell (baseline)', build, options['repeat'])
+                if not options['keep']:
+                    raise Rollback
+        except Rollback:
+            self.stdout.write('Synthetic data rolled back')
+
+    def report(self, name, build, repeat):
+        self.stdout.write(self.style.MIGRATE_HEADING(name))
+        elapsed = []
+        for _ in range(repeat):
+            started = time.monotonic()
+            with build() as output:
+                elapsed.append(time.monotonic() - started)
+                size = output.seek(0, 2)
+        tracemalloc.start()
+        build().close()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.stdout.write(f'{min(elapsed) * 1000:.0f} ms best of {repeat}, '
+                          f'{peak / 2 ** 20:.1f} MiB peak allocations, {size / 1024:.0f} KiB file\n')
@@ -0,0 +1,140 @@
+"""Query plans and timings of the bot and admin hot path queries
+
+Seeds a synthetic schedule (places x days x CLASSES_HOURS slots filled with
+random users) into the configured database, prints EXPLAIN and the average
+time of every query and rolls the data back, unless --keep is given. Runs on
+any backend Django is configured with, e.g. SQLite locally and PostgreSQL
+through DATABASE_URL.
+"""
+import datetime as dt
+import random
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from time_chart.management.commands.config import CLASSES_HOURS, TIME_FORMAT
+from time_chart.models import (
+    Attendance,
+    AttendanceRollup,
+    DailyBookings,
+    Group,
+    Place,
+    TimeSlot,
+    User,
+    WeeklyBookings,
+)
+
+# synthetic users get ids far above the Telegram ones
+USER_ID_OFFSET = 10 ** 15
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Seed a synthetic schedule and print EXPLAIN and timings of the hot path queries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--days', type=int, default=365, help='Days of schedule, half of them in the past')
+        parser.add_argument('--places', type=int, default=3)
+        parser.add_argument('--repeat', type=int, default=20, help='Runs of every query')
+        parser.add_argument('--keep', action='store_true', help='Keep the synthetic data')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'Database: {connection.vendor}')
+        try:
+            with transaction.atomic():
+                sample = self.seed(options['users'], options['days'], options['places'])
+                for name, qs in self.queries(*sample):
+                    self.report(name, qs, options['repeat'])
+                if not options['keep']:
+                    raise Rollback
+        except Rollback:
+            self.stdout.write('Synthetic data rolled back')
+
+    def seed(self, users_count, days, places_count):
+        started = time.monotonic()
+        groups = [Group.objects.create(name=f'bench-{i}', allow_signup=True) for i in range(5)]
+        places = [Place.objects.create(name=f'bench-{i}') for i in range(places_count)]
+        users = User.objects.bulk_create(
+            [User(id=USER_ID_OFFSET + i, last_name=f'Bench{i}', group=random.choice(groups))
+             for i in range(users_count)],
+            batch_size=1000)
+
+        first_day = dt.date.today() - dt.timedelta(days=days // 2)
+        times = [dt.datetime.strptime(t, TIME_FORMAT).time() for t in CLASSES_HOURS]
+        TimeSlot.objects.bulk_create(
+            [TimeSlot(place=place, date=first_day + dt.timedelta(days=day), time=t, open=True)
+             for place in places for day in range(days) for t in times],
+            batch_size=1000)
+        slots = list(TimeSlot.objects.filter(place__in=places).values_list('pk', 'date', 'limit'))
+
+        through = TimeSlot.people.through
+        allowed = TimeSlot.allowed_groups.through
+        rows, group_rows = [], []
+        weekly, daily, visits = Counter(), Counter(), Counter()
+        rolled_up = AttendanceRollup.until()
+        for slot_pk, date, limit in slots:
+            for user in random.sample(users, min(limit, len(users))):
+                rows.append(through(timeslot_id=slot_pk, user_id=user.pk))
+                year, week, _ = date.isocalendar()
+                weekly[(user.pk, year, week)] += 1
+                daily[(user.pk, date)] += 1
+                if rolled_up is not None and date < rolled_up:
+                    visits[user.pk] += 1
+            if random.random() < 0.3:
+                group_rows.append(allowed(timeslot_id=slot_pk, group_id=random.choice(groups).pk))
+        through.objects.bulk_create(rows, batch_size=5000)
+        allowed.objects.bulk_create(group_rows, batch_size=5000)
+        WeeklyBookings.objects.bulk_create(
+            [WeeklyBookings(user_id=key[0], year=key[1], week=key[2], bookings=value)
+             for key, value in weekly.items()],
+            batch_size=5000)
+        DailyBookings.objects.bulk_create(
+            [DailyBookings(user_id=key[0], date=key[1], bookings=value) for key, value in daily.items()],
+            batch_size=5000)
+        Attendance.objects.bulk_create(
+            [Attendance(user_id=key, visits=value) for key, value in visits.items()],
+            batch_size=5000)
+
+        self.stdout.write(f'Seeded {len(users)} users, {len(slots)} time slots, {len(rows)} bookings '
+                          f'in {time.monotonic() - started:.1f}s')
+        return random.choice(places), random.choice(groups), random.choice(users)
+
+    def queries(self, place, group, user):
+        today = dt.date.today()
+        day = today + dt.timedelta(days=3)
+        return [
+            ('ask_date: open dates of a place',
+             TimeSlot.objects.filter(place__name=place.name, open=True, date__gt=today)
+             .for_group(group.pk).with_free_seats().filter(free_seats__gt=0).values('date').distinct()),
+            ('ask_time: free slots of a place and date',
+             TimeSlot.objects.filter(open=True, place__name=place.name, date=day).for_group(group.pk)
+             .with_free_seats().filter(free_seats__gt=0).order_by('time').values_list('pk', 'time', 'free_seats')),
+            ('availability index: place load',
+             TimeSlot.objects.filter(open=True, date__gte=today, place__name=place.name)
+             .with_free_seats().values_list('pk', 'place__name', 'date', 'time', 'limit', 'people_count')),
+            ('week limit: WeeklyBookings lookup',
+             WeeklyBookings.objects.filter(user_id=user.pk, year=day.isocalendar()[0], week=day.isocalendar()[1])
+             .values_list('bookings', flat=True)),
+            ('day rule: DailyBookings lookup',
+             DailyBookings.objects.filter(user_id=user.pk, date=day).values_list('bookings', flat=True)),
+            ('ask_unsubscribe: future bookings of a user',
+             TimeSlot.objects.filter(people__id=user.pk, date__gt=today)
+             .values_list('pk', 'place__name', 'date', 'time')),
+            ('admin changelist: future slots',
+             TimeSlot.objects.filter(date__gte=today).order_by('date', 'time', 'place')[:100]),
+        ]
+
+    def report(self, name, qs, repeat):
+        self.stdout.write(self.style.MIGRATE_HEADING(name))
+        self.stdout.write(qs.explain())
+        started = time.monotonic()
+        for _ in range(repeat):
+            list(qs.all())
+        elapsed = (time.monotonic() - started) / repeat * 1000
+        self.stdout.write(f'{elapsed:.2f} ms per query\n')
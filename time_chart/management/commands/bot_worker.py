@@ -5,19 +5,31 @@ Conversation:
  with a capital or a lowercase letter. To ask bot to unsubscribe you from a class
  write: О[о]тпиши меня or О[о]тмени запись.
  Then follow it's instructions.
+
+Updates are received either by long polling (``manage.py bot_worker``) or by
+the webhook served by the web site (see ``time_chart.webhook``). Run
+``manage.py bot_worker --set-webhook https://<site>`` to switch the bot to the
+webhook, starting the polling worker switches it back.
 """
 import random
-from django.core.management.base import BaseCommand
+from queue import Queue
+from threading import Thread
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
 
-from telegram import ReplyKeyboardRemove
+from telegram import Bot, ReplyKeyboardRemove, Update
 from telegram.ext import (
     CommandHandler,
     ConversationHandler,
+    Dispatcher,
     Filters,
+    JobQueue,
     MessageHandler,
-    PicklePersistence,
+    TypeHandler,
     Updater
 )
+from telegram.utils.request import Request
 
 from time_chart.management.commands.config import (
     ACCEPT_TERMS_STATE,
@@ -28,8 +40,10 @@ from time_chart.management.commands.config import (
     ASK_LAST_NAME_STATE,
     RETURN_UNSUBSCRIBE_STATE,
     BOT_TOKEN,
+    BOT_WORKERS,
+    WEBHOOK_SECRET,
 )
-from time_chart.management.commands.tools import logger
+from time_chart.management.commands.tools import db_connection, logger
 from time_chart.management.commands.user_handlers import (
     start_cmd,
     store_group_num,
@@ -42,6 +56,7 @@ from time_chart.management.commands.user_handlers import (
     ask_unsubscribe,
     unsubscribe,
 )
+from time_chart.persistence import DatabasePersistence
 
 
 SMILEYS = [
@@ -97,26 +112,89 @@ def unknown(update, context):
     bot.send_message(chat_id=update.message.chat_id, text="Извини, не знаю такой команды.")
 
 
-def run_bot():
-    pp = PicklePersistence(filename='conversationbot')
-    updater = Updater(token=BOT_TOKEN, use_context=True, persistence=pp)
-    dispatcher = updater.dispatcher
+def reload_data(update, context):
+    """Load the user and chat data of the update, the previous update of the
+    user may have been handled by another process"""
+    context.dispatcher.persistence.refresh(context.dispatcher, update)
+
+
+def make_persistence():
+    return DatabasePersistence()
+
 
-    cancel_handler = CommandHandler('cancel', end_conversation)
-    unknown_handler = MessageHandler(Filters.command, unknown)
+class PerUserDispatcher(Dispatcher):
+    """Dispatcher processing the updates of different users concurrently
+
+    Every user is bound to one of ``lanes`` threads processing its updates one
+    by one, so the next update of the user always finds the conversation state
+    and the user data stored by the previous one, while a slow handler only
+    delays the users sharing its lane. Updates without a user and errors are
+    processed in the dispatcher thread, ``lanes`` = 0 processes all of them
+    there.
+    """
+
+    def __init__(self, *args, lanes=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lanes = []
+        for number in range(lanes):
+            lane = Queue()
+            thread = Thread(target=self._run_lane, args=(lane,),
+                            name='update_lane_{}'.format(number), daemon=True)
+            thread.start()
+            self._lanes.append((lane, thread))
+
+    def _run_lane(self, lane):
+        while True:
+            update = lane.get()
+            if update is None:
+                break
+            try:
+                super().process_update(update)
+            except Exception:
+                logger.exception('Failed to process update "%s"', update)
+        connection.close()
+
+    def process_update(self, update):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None or not self._lanes:
+            super().process_update(update)
+            return
+        lane, _ = self._lanes[user.id % len(self._lanes)]
+        lane.put(update)
+
+    def stop(self):
+        """Stop the dispatcher once the queued updates are processed"""
+        super().stop()
+        for lane, _ in self._lanes:
+            lane.put(None)
+        for _, thread in self._lanes:
+            thread.join()
+        self._lanes = []
+
+
+def setup_dispatcher(dispatcher):
+    """Register the bot handlers"""
+    def callback(func):
+        return db_connection(func)
+
+    # before any other handler
+    dispatcher.add_handler(TypeHandler(Update, callback(reload_data)), group=-1)
+
+    cancel_handler = CommandHandler('cancel', callback(end_conversation))
+    unknown_handler = MessageHandler(Filters.command, callback(unknown))
 
     # Add user identity handler on /start command
     identity_handler = ConversationHandler(
-        entry_points=[CommandHandler('start', start_cmd)],
+        entry_points=[CommandHandler('start', callback(start_cmd))],
         states={
-            ACCEPT_TERMS_STATE: [MessageHandler(Filters.text, accept_terms,
+            ACCEPT_TERMS_STATE: [MessageHandler(Filters.text, callback(accept_terms),
                                                 pass_user_data=True)],
-            ASK_GROUP_NUM_STATE: [MessageHandler(Filters.text, store_group_num)],
-            ASK_LAST_NAME_STATE: [MessageHandler(Filters.text, store_last_name)],
+            ASK_GROUP_NUM_STATE: [MessageHandler(Filters.text, callback(store_group_num))],
+            ASK_LAST_NAME_STATE: [MessageHandler(Filters.text, callback(store_last_name))],
         },
-        fallbacks=[CommandHandler('cancel', end_conversation)],
+        fallbacks=[CommandHandler('cancel', callback(end_conversation))],
         name="identity_conversation",
-        # persistent=True,
+        persistent=True,
     )
 
     dispatcher.add_handler(identity_handler)
@@ -125,36 +203,48 @@ def run_bot():
 
     # Add subscribe handler with the states ASK_DATE_STATE, ASK_TIME_STATE
     sign_up_conv_handler = ConversationHandler(
-        entry_points=[MessageHandler(Filters.regex(".*([Зз]апиши меня).*"), ask_place)],
+        entry_points=[MessageHandler(Filters.regex(".*([Зз]апиши меня).*"), callback(ask_place))],
         states={
-            ASK_PLACE_STATE: [MessageHandler(Filters.text, ask_date, pass_user_data=True)],
-            ASK_DATE_STATE: [MessageHandler(Filters.text, ask_time, pass_user_data=True)],
-            ASK_TIME_STATE: [MessageHandler(Filters.text, store_sign_up, pass_user_data=True)],
+            ASK_PLACE_STATE: [MessageHandler(Filters.text, callback(ask_date), pass_user_data=True)],
+            ASK_DATE_STATE: [MessageHandler(Filters.text, callback(ask_time), pass_user_data=True)],
+            ASK_TIME_STATE: [MessageHandler(Filters.text, callback(store_sign_up), pass_user_data=True)],
         },
-        fallbacks=[CommandHandler('cancel', end_conversation)],
+        fallbacks=[CommandHandler('cancel', callback(end_conversation))],
         name="subscribe_conversation",
-        # persistent=True
+        persistent=True,
     )
     dispatcher.add_handler(sign_up_conv_handler)
 
     # Add unsubscribe handler with the states
     unsubscribe_conv_handler = ConversationHandler(
-        entry_points=[MessageHandler(Filters.regex(".*([Оо]тпиши меня|[Оо]тмени запись).*"), ask_unsubscribe)],
+        entry_points=[MessageHandler(Filters.regex(".*([Оо]тпиши меня|[Оо]тмени запись).*"), callback(ask_unsubscribe))],
         states={
-            RETURN_UNSUBSCRIBE_STATE: [MessageHandler(Filters.text, unsubscribe)],
+            RETURN_UNSUBSCRIBE_STATE: [MessageHandler(Filters.text, callback(unsubscribe))],
         },
-        fallbacks=[CommandHandler('cancel', end_conversation)],
+        fallbacks=[CommandHandler('cancel', callback(end_conversation))],
         name="unsubscribe_conversation",
-        # persistent=True
+        persistent=True,
     )
     dispatcher.add_handler(unsubscribe_conv_handler)
 
-    text_msg_handler = MessageHandler(Filters.text, unknown)
+    text_msg_handler = MessageHandler(Filters.text, callback(unknown))
     dispatcher.add_handler(text_msg_handler)
 
     # log all errors
     dispatcher.add_error_handler(error)
 
+
+def run_bot(workers=BOT_WORKERS):
+    """Start polling for updates"""
+    bot = Bot(BOT_TOKEN, request=Request(con_pool_size=workers + 4))
+    job_queue = JobQueue()
+    dispatcher = PerUserDispatcher(bot, Queue(), workers=0, job_queue=job_queue,
+                                   persistence=make_persistence(), use_context=True,
+                                   lanes=workers)
+    job_queue.set_dispatcher(dispatcher)
+    setup_dispatcher(dispatcher)
+    updater = Updater(dispatcher=dispatcher, workers=None, use_context=True)
+
     updater.start_polling(clean=True)
 
     updater.idle()
@@ -163,5 +253,20 @@ def run_bot():
 class Command(BaseCommand):
     help = 'Telegram bot worker'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=BOT_WORKERS,
+                            help='Number of threads processing the updates of different users '
+                                 'concurrently, 0 processes all of them one by one')
+        parser.add_argument('--set-webhook', metavar='BASE_URL',
+                            help='Point the bot webhook to the web site at BASE_URL and exit '
+                                 'instead of polling')
+
     def handle(self, *args, **options):
-        run_bot()
+        if options['set_webhook']:
+            if not WEBHOOK_SECRET:
+                raise CommandError('WEBHOOK_SECRET is not set')
+            url = '{}/bot/{}/'.format(options['set_webhook'].rstrip('/'), WEBHOOK_SECRET)
+            Bot(BOT_TOKEN).set_webhook(url=url)
+            self.stdout.write('Webhook is set')
+            return
+        run_bot(workers=options['workers'])
@@ -0,0 +1,55 @@
+"""Sends the messages queued as ``BroadcastJob`` rows
+
+Several workers may run at once, every job is claimed by one of them with
+a conditional update (see ``Job.claim``). A job left running by a worker
+that died is sent again after BROADCAST_JOB_TIMEOUT, so a chat may get the
+message twice. Finished jobs older than BROADCAST_JOB_KEEP_DAYS are deleted.
+"""
+import datetime as dt
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from time_chart.broadcast import run_broadcast_job
+from time_chart.management.commands.config import (
+    BROADCAST_JOB_KEEP_DAYS,
+    BROADCAST_JOB_TIMEOUT,
+    BROADCAST_POLL_INTERVAL,
+)
+from time_chart.management.commands.tools import db_connection, logger
+from time_chart.models import BroadcastJob
+
+
+class Command(BaseCommand):
+    help = 'Send the queued broadcasts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Exit when there are no pending jobs')
+        parser.add_argument('--poll', type=float, default=BROADCAST_POLL_INTERVAL,
+                            help='Seconds to sleep when there are no pending jobs')
+
+    def handle(self, *args, **options):
+        logger.info('Broadcast worker started')
+        while True:
+            if not self.step():
+                if options['once']:
+                    break
+                time.sleep(options['poll'])
+
+    @db_connection
+    def step(self):
+        """Send one job, returns False when there was none"""
+        job = BroadcastJob.claim(BROADCAST_JOB_TIMEOUT)
+        if job is None:
+            return False
+        report = run_broadcast_job(job)
+        if report is not None:
+            logger.info('Broadcast job %s to %s chats: %s', job.pk, len(job.chat_ids), report)
+            if report.failed:
+                logger.warning('Broadcast job %s not delivered to: %s', job.pk, report.failed)
+        BroadcastJob.objects.filter(
+            status__in=(BroadcastJob.DONE, BroadcastJob.FAILED),
+            created__lt=timezone.now() - dt.timedelta(days=BROADCAST_JOB_KEEP_DAYS),
+        ).delete()
+        return True
@@ -3,6 +3,57 @@ import os
 # bot config
 BOT_TOKEN = os.environ['BOT_TOKEN']
 
+# secret part of the webhook url, the webhook is disabled when empty
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+
+# notifications sent to many users at once
+BROADCAST_CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY', 8))
+BROADCAST_RATE = int(os.environ.get('BROADCAST_RATE', 25))  # messages per second, Telegram allows ~30
+BROADCAST_TIMEOUT = int(os.environ.get('BROADCAST_TIMEOUT', 10))  # seconds per request
+BROADCAST_RETRIES = int(os.environ.get('BROADCAST_RETRIES', 3))
+# seconds the broadcast worker sleeps when there is no job
+BROADCAST_POLL_INTERVAL = int(os.environ.get('BROADCAST_POLL_INTERVAL', 5))
+# seconds after which a running job is considered abandoned and sent again
+BROADCAST_JOB_TIMEOUT = int(os.environ.get('BROADCAST_JOB_TIMEOUT', 3600))
+# days finished broadcast jobs and their reports are kept
+BROADCAST_JOB_KEEP_DAYS = int(os.environ.get('BROADCAST_JOB_KEEP_DAYS', 30))
+
+# number of threads processing the updates of different users concurrently,
+# the updates of one user are processed in order, 0 processes all of them
+# one by one in the dispatcher thread
+BOT_WORKERS = int(os.environ.get('BOT_WORKERS', 0))
+# seconds a database connection may stay idle before it is checked prior to use
+DB_HEALTH_CHECK_INTERVAL = int(os.environ.get('DB_HEALTH_CHECK_INTERVAL', 30))
+
+# seconds after which the bot reloads free seats of a place from the database
+AVAILABILITY_INDEX_TTL = int(os.environ.get('AVAILABILITY_INDEX_TTL', 60))
+# seconds browsers and CDNs may reuse an answer of the availability API without asking
+API_CACHE_MAX_AGE = int(os.environ.get('API_CACHE_MAX_AGE', 60))
+
+# time slots read from the database at once by the exports
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 500))
+# bytes of an export file stored in one database row
+EXPORT_FILE_PART_SIZE = int(os.environ.get('EXPORT_FILE_PART_SIZE', 1024 * 1024))
+# seconds the export worker sleeps when there is no job
+EXPORT_POLL_INTERVAL = int(os.environ.get('EXPORT_POLL_INTERVAL', 2))
+# seconds after which a running job is considered abandoned and taken again
+EXPORT_JOB_TIMEOUT = int(os.environ.get('EXPORT_JOB_TIMEOUT', 1800))
+# days finished export jobs and their files are kept
+EXPORT_JOB_KEEP_DAYS = int(os.environ.get('EXPORT_JOB_KEEP_DAYS', 7))
+
+# users offered by the admin autocomplete and seconds its answers are cached
+AUTOCOMPLETE_LIMIT = int(os.environ.get('AUTOCOMPLETE_LIMIT', 50))
+AUTOCOMPLETE_CACHE_TTL = int(os.environ.get('AUTOCOMPLETE_CACHE_TTL', 30))
+
+# days ahead the schedule templates are turned into time slots
+SCHEDULE_HORIZON_DAYS = int(os.environ.get('SCHEDULE_HORIZON_DAYS', 28))
+# time slots created by one query
+SCHEDULE_BATCH_SIZE = int(os.environ.get('SCHEDULE_BATCH_SIZE', 500))
+
+# age in days of the time slots moved into the archive and slots moved per transaction
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 180))
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', 500))
+
 CLASSES_HOURS = ["10:00", "12:00", "14:00", "16:00", "18:00", "20:00"]
 
 DATE_FORMAT = "%Y-%m-%d"
@@ -0,0 +1,46 @@
+"""Dumps the schedule or the user report as CSV or NDJSON
+
+The rows are read from the database in chunks and written as they come, so
+histories of any length are dumped in constant memory, e.g.
+
+    manage.py export_data schedule --format ndjson --since 2019-01-01 > schedule.ndjson
+"""
+import datetime as dt
+import sys
+
+from django.core.management.base import BaseCommand
+
+from time_chart.exports import REPORT_COLUMNS, SCHEDULE_COLUMNS, attendance_rows, report_users, schedule_rows, stream
+from time_chart.models import TimeSlot, User
+
+
+class Command(BaseCommand):
+    help = 'Write the schedule or the user report as CSV or NDJSON to a file or stdout'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=('schedule', 'report'))
+        parser.add_argument('--format', choices=('csv', 'ndjson'), default='csv')
+        parser.add_argument('--output', default='-', help='File to write, stdout by default')
+        parser.add_argument('--since', type=dt.date.fromisoformat, help='First date of the schedule')
+        parser.add_argument('--until', type=dt.date.fromisoformat, help='Last date of the schedule')
+
+    def handle(self, *args, **options):
+        if options['kind'] == 'schedule':
+            slots = TimeSlot.objects.all()
+            if options['since']:
+                slots = slots.filter(date__gte=options['since'])
+            if options['until']:
+                slots = slots.filter(date__lte=options['until'])
+            columns, rows = SCHEDULE_COLUMNS, schedule_rows(slots)
+        else:
+            columns, rows = REPORT_COLUMNS, attendance_rows(report_users(User.objects.all()))
+
+        if options['output'] == '-':
+            self.write(sys.stdout, options['format'], columns, rows)
+        else:
+            with open(options['output'], 'w', newline='', encoding='utf-8') as output:
+                self.write(output, options['format'], columns, rows)
+
+    def write(self, output, fmt, columns, rows):
+        for block in stream(fmt, columns, rows):
+            output.write(block)
@@ -0,0 +1,52 @@
+"""Builds the admin exports queued as ``ExportJob`` rows
+
+Several workers may run at once, every job is claimed by one of them with
+a conditional update (see ``Job.claim``). Finished jobs older than
+EXPORT_JOB_KEEP_DAYS are deleted together with their files.
+"""
+import datetime as dt
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from time_chart.exports import run_export_job
+from time_chart.management.commands.config import (
+    EXPORT_JOB_KEEP_DAYS,
+    EXPORT_JOB_TIMEOUT,
+    EXPORT_POLL_INTERVAL,
+)
+from time_chart.management.commands.tools import db_connection, logger
+from time_chart.models import ExportJob
+
+
+class Command(BaseCommand):
+    help = 'Build the queued admin exports'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Exit when there are no pending jobs')
+        parser.add_argument('--poll', type=float, default=EXPORT_POLL_INTERVAL,
+                            help='Seconds to sleep when there are no pending jobs')
+
+    def handle(self, *args, **options):
+        logger.info('Export worker started')
+        while True:
+            if not self.step():
+                if options['once']:
+                    break
+                time.sleep(options['poll'])
+
+    @db_connection
+    def step(self):
+        """Run one job, returns False when there was none"""
+        job = ExportJob.claim(EXPORT_JOB_TIMEOUT)
+        if job is None:
+            return False
+        started = time.monotonic()
+        done = run_export_job(job)
+        logger.info('Export job %s %s in %.1fs', job.pk, 'done' if done else 'failed', time.monotonic() - started)
+        ExportJob.objects.filter(
+            status__in=(ExportJob.DONE, ExportJob.FAILED),
+            created__lt=timezone.now() - dt.timedelta(days=EXPORT_JOB_KEEP_DAYS),
+        ).delete()
+        return True
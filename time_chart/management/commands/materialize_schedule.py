@@ -0,0 +1,28 @@
+"""Creates the time slots of the schedule templates for the coming days
+
+Run it nightly: every template continues after the last date it was
+materialized for, so slots removed in the admin are not created again and
+a run over an up to date schedule costs a couple of queries. ``--since``
+fills in the missing slots again from the given date.
+"""
+import datetime as dt
+
+from django.core.management.base import BaseCommand
+
+from time_chart.management.commands.config import SCHEDULE_HORIZON_DAYS
+from time_chart.models import ScheduleTemplate
+from time_chart.schedule import materialize_templates
+
+
+class Command(BaseCommand):
+    help = 'Create the missing time slots of the schedule templates'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=SCHEDULE_HORIZON_DAYS, help='Days ahead to create')
+        parser.add_argument('--since', type=dt.date.fromisoformat,
+                            help='Create the missing slots from this date instead of after the last run')
+
+    def handle(self, *args, **options):
+        end = dt.date.today() + dt.timedelta(days=options['days'])
+        created = materialize_templates(ScheduleTemplate.objects.all(), end, start=options['since'])
+        self.stdout.write(f'{created} time slots created up to {end}')
@@ -0,0 +1,53 @@
+"""Moves the past bookings into the Attendance counters
+
+Run it nightly (e.g. from the Heroku scheduler), ``Attendance.visits_of``
+adds the days not rolled up yet from DailyBookings, so a missed run only
+makes the reads a bit slower. Admin edits of the bookings of the rolled up
+days made while the command runs may be missed, ``--rebuild`` recounts all
+the counters from the bookings, the archived ones included.
+"""
+import datetime as dt
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+
+from time_chart.models import ArchivedBooking, Attendance, AttendanceRollup, DailyBookings, TimeSlot
+
+
+class Command(BaseCommand):
+    help = 'Add the bookings of the past days to the attendance counters'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help='Recount all the counters')
+
+    def handle(self, *args, **options):
+        today = dt.date.today()
+        with transaction.atomic():
+            rollup = AttendanceRollup.objects.select_for_update().filter(pk=1).first()
+            if options['rebuild'] or rollup is None:
+                Attendance.objects.all().delete()
+                visits = Counter()
+                for model in (TimeSlot.people.through, ArchivedBooking):
+                    visits.update(dict(model.objects.filter(timeslot__date__lt=today).values(
+                        'user_id').annotate(visits=Count('id')).values_list('user_id', 'visits')))
+                Attendance.objects.bulk_create(
+                    [Attendance(user_id=user_id, visits=count) for user_id, count in visits.items()],
+                    batch_size=1000)
+                AttendanceRollup.objects.update_or_create(pk=1, defaults={'date': today})
+                self.stdout.write(f'Attendance recounted up to {today}')
+                return
+
+            if rollup.date >= today:
+                self.stdout.write(f'Attendance is rolled up to {rollup.date} already')
+                return
+            visits = DailyBookings.objects.filter(date__gte=rollup.date, date__lt=today, bookings__gt=0).values(
+                'user_id').annotate(visits=Sum('bookings')).values_list('user_id', 'visits')
+            users = 0
+            for user_id, count in visits.iterator():
+                Attendance.add(user_id, count)
+                users += 1
+            self.stdout.write(f'Rolled up {rollup.date} - {today - dt.timedelta(days=1)} for {users} users')
+            rollup.date = today
+            rollup.save()
@@ -1,8 +1,11 @@
 import logging
 import os
 import re
+import threading
+import time
 from functools import wraps
 
+from django.db import close_old_connections, connection
 from telegram import (
     KeyboardButton,
     ReplyKeyboardMarkup,
@@ -10,6 +13,7 @@ from telegram import (
 )
 
 from time_chart.management.commands.config import (
+    DB_HEALTH_CHECK_INTERVAL,
     LIST_OF_ADMINS,
 )
 
@@ -39,6 +43,34 @@ def restricted(msg="Ага, счас! Только администратору
     return restricted_deco
 
 
+_connection_state = threading.local()
+
+
+def db_connection(func):
+    """Run a handler with a usable database connection
+
+    Every dispatcher thread holds its own Django connection. Connections older
+    than CONN_MAX_AGE or broken ones are closed around the handler and
+    a connection idle for more than DB_HEALTH_CHECK_INTERVAL seconds is
+    checked before use, so the handler does not fail on a connection dropped
+    by the server in the meantime.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        close_old_connections()
+        last_used = getattr(_connection_state, 'last_used', None)
+        if (connection.connection is not None and last_used is not None
+                and time.monotonic() - last_used > DB_HEALTH_CHECK_INTERVAL
+                and not connection.is_usable()):
+            connection.close()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _connection_state.last_used = time.monotonic()
+            close_old_connections()
+    return wrapper
+
+
 class ReplyKeyboardWithCancel(ReplyKeyboardMarkup):
 
     def __init__(self,
@@ -1,6 +1,5 @@
 import datetime as dt
 
-from django.db.models import Count, F, Q
 from telegram import (
     ReplyKeyboardRemove,
     KeyboardButton,
@@ -9,7 +8,19 @@ from telegram import (
 from telegram.ext import ConversationHandler
 from telegram.parsemode import ParseMode
 
-from time_chart.models import Group, User, Place, TimeSlot
+from time_chart import availability, profiles
+from time_chart.models import (
+    DailyBookings,
+    Group,
+    User,
+    Place,
+    Reservation,
+    ScheduleVersion,
+    TimeSlot,
+    UserVersion,
+    WeeklyBookings,
+    start_of_the_week,
+)
 
 from time_chart.management.commands.config import (
     ACCEPT_TERMS_STATE,
@@ -107,6 +118,9 @@ def store_group_num(update, context):
     try:
         group = Group.objects.get(name=group_name)
         User.objects.filter(pk=user_id).update(group=group.id)
+        profiles.invalidate(context)
+        ScheduleVersion.bump()
+        UserVersion.bump()
     except Exception as e:
         logger.error('Update "%s" caused error "%s"', update, e)
         bot.send_message(chat_id=update.message.chat_id,
@@ -128,7 +142,10 @@ def store_last_name(update, context):
                          text="Я немного не понял. Просто напиши свою фамилию.")
         return ASK_LAST_NAME_STATE
     User.objects.filter(pk=user_id).update(last_name=last_name)
-    usr = User.objects.get(pk=user_id)
+    profiles.invalidate(context)
+    ScheduleVersion.bump()
+    UserVersion.bump()
+    usr = profiles.get_profile(update, context)
     bot.send_message(chat_id=update.message.chat_id,
                      text=f"Твоя фамилия {usr.last_name} и ты из группы {usr.group.name}, "
                           f"верно? Если нет, нажми /start и измени данные. Если все верно, то попробуй написать мне"
@@ -142,7 +159,7 @@ def ask_place(update, context):
     """Entry point for 'subscribe' user conversation"""
     user_id = update.effective_user.id
     bot = context.bot
-    usr = User.objects.get(pk=user_id)
+    usr = profiles.get_profile(update, context)
 
     signup_allowed = usr.group.allow_signup
     if not signup_allowed:
@@ -157,14 +174,8 @@ def ask_place(update, context):
                          reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END
 
-    today = dt.date.today()
-    if today.weekday() == 6:  # 6 == sunday
-        start_of_the_week = today + dt.timedelta(days=1)
-    else:
-        start_of_the_week = today - dt.timedelta(days=today.weekday())
-    subs = TimeSlot.objects.filter(people__pk=usr.pk,
-                                   date__gte=start_of_the_week)
-    if user_id not in LIST_OF_ADMINS and len(subs) >= usr.group.week_limit:
+    week_bookings = WeeklyBookings.of(usr.pk, start_of_the_week(dt.date.today()))
+    if user_id not in LIST_OF_ADMINS and week_bookings >= usr.group.week_limit:
         bot.send_message(chat_id=update.message.chat_id,
                          text="У тебя уже достигнут лимит записей на эту неделю. "
                               "Сначала отмени другую запись.",
@@ -203,30 +214,18 @@ def ask_date(update, context):
     start_date = dt.date.today()
     if is_past_19():
         start_date = dt.date.today() + dt.timedelta(days=1)
-    user_id = update.effective_user.id
-    usr = User.objects.get(pk=user_id)
-    qs = TimeSlot.objects.annotate(people_count=Count('people')).filter(
-        Q(allowed_groups=usr.group) | Q(allowed_groups__isnull=True),
-        open=True,
-        date__gt=start_date,
-        place__name=msg,
-        limit__gt=F('people_count')
-    ).order_by('date')
-    time_slots = {}
-    for ts in qs:
-        time_slots[ts.date] = ts
-    time_slots = time_slots.values()
-    if not time_slots:
+    usr = profiles.get_profile(update, context)
+    dates = availability.index.dates(msg, usr.group_id, start_date)
+    if not dates:
         bot.send_message(chat_id=update.message.chat_id,
                          text="Нету открытых дат для записи.",
                          reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END
 
     keyboard = [[
-        InlineKeyboardButton("{} {}".format(WEEKDAYS_SHORT[time_slot.date.weekday()],
-                                            time_slot.date),
-                             callback_data=str(time_slot.date))
-    ] for time_slot in time_slots]
+        InlineKeyboardButton("{} {}".format(WEEKDAYS_SHORT[date.weekday()], date),
+                             callback_data=str(date))
+    ] for date in dates]
     reply_markup = ReplyKeyboardWithCancel(keyboard, one_time_keyboard=True)
     bot.send_message(chat_id=update.message.chat_id,
                      text="На когда?",
@@ -268,8 +267,7 @@ def ask_time(update, context):
 
     # check for existing subscription for the date, 2 subs are not allowed per user per date
     user_id = update.effective_user.id
-    subs = TimeSlot.objects.filter(people__pk=user_id, date=date)
-    if user_id not in LIST_OF_ADMINS and len(subs) > 0:
+    if user_id not in LIST_OF_ADMINS and DailyBookings.of(user_id, date):
         bot.send_message(chat_id=update.message.chat_id,
                          text="У тебя уже есть запись на {}. "
                               "Чтобы записаться отмени ранее сделанную запись.".format(date),
@@ -278,25 +276,13 @@ def ask_time(update, context):
     context.user_data['date'] = date
     place = context.user_data['place']
     user_id = update.effective_user.id
-    usr = User.objects.get(pk=user_id)
-    qs = TimeSlot.objects.annotate(people_count=Count('people')).filter(
-        Q(allowed_groups=usr.group) | Q(allowed_groups__isnull=True),
-        date=date,
-        place__name=place,
-        open=True,
-        limit__gt=F('people_count')
-    ).order_by('time')
-    time_slots = {}
-    for ts in qs:
-        time_slots[ts.time] = ts
-    time_slots = time_slots.values()
+    usr = profiles.get_profile(update, context)
     keyboard = [[
         KeyboardButton(
-            "{} (свободно слотов {})".format(time_slot.time.strftime("%H:%M"),
-                                             time_slot.limit - time_slot.people.count()),
-            callback_data=str(time_slot.time)
+            "{} (свободно слотов {})".format(time.strftime("%H:%M"), free),
+            callback_data=str(time)
         )
-    ] for time_slot in time_slots]
+    ] for _, time, free in availability.index.times(place, date, usr.group_id)]
     reply_markup = ReplyKeyboardWithCancel(keyboard, one_time_keyboard=True)
     bot.send_message(chat_id=update.message.chat_id,
                      text="Теперь выбери время",
@@ -324,28 +310,50 @@ def store_sign_up(update, context):
     place = context.user_data['place']
     user_id = update.effective_user.id
 
-    time_slot = TimeSlot.objects.get(date=date, place__name=place, time=time)
+    if date == (dt.date.today() + dt.timedelta(days=1)) and is_past_19():
+        bot.send_message(chat_id=update.message.chat_id,
+                         text="Не получилось записать. Запись на 'завтра' можно совершить до 19:00. "
+                              "Попробуй записаться на другую дату.",
+                         reply_markup=ReplyKeyboardRemove())
+        return ConversationHandler.END
 
-    if not time_slot.open:
+    user = profiles.get_profile(update, context)
+    # closed, full and not allowed slots are reported by reserve
+    slot_pk = TimeSlot.objects.filter(place__name=place, date=date, time=time).values_list('pk', flat=True).first()
+    if slot_pk is None:
+        bot.send_message(chat_id=update.message.chat_id,
+                         text="Упс, на это время записаться уже нельзя. "
+                              "Попробуй записаться на другое время.",
+                         reply_markup=ReplyKeyboardRemove())
+        return ConversationHandler.END
+
+    result = TimeSlot(pk=slot_pk).reserve(user, check_quota=user_id not in LIST_OF_ADMINS)
+
+    if result is Reservation.BOOKED:
+        bot.send_message(chat_id=update.message.chat_id,
+                         text="Ok, записал на {} {} {}".format(
+                             place, date, time.strftime("%H:%M")),
+                         reply_markup=ReplyKeyboardRemove())
+    elif result is Reservation.CLOSED:
         bot.send_message(chat_id=update.message.chat_id,
                          text="Упс, этот тайм слот закрыт для записи в данный момент. "
                               "Попробуй записаться на другое время или узнай у "
-                              "администратора когда будет открыта запись на этот.".format(time_slot.limit))
-    if time_slot.people.count() >= time_slot.limit:
+                              "администратора когда будет открыта запись на этот.",
+                         reply_markup=ReplyKeyboardRemove())
+    elif result is Reservation.FULL:
         bot.send_message(chat_id=update.message.chat_id,
-                         text="Упс, на этот тайм слот уже записалось {} человек. "
-                              "Попробуй записаться на другое время.".format(time_slot.people.count()))
-    elif date == (dt.date.today() + dt.timedelta(days=1)) and is_past_19():
+                         text="Упс, на этот тайм слот уже записалось максимальное число человек. "
+                              "Попробуй записаться на другое время.",
+                         reply_markup=ReplyKeyboardRemove())
+    elif result is Reservation.DAY_TAKEN:
         bot.send_message(chat_id=update.message.chat_id,
-                         text="Не получилось записать. Запись на 'завтра' можно совершить до 19:00. "
-                              "Попробуй записаться на другую дату.".format(time_slot.limit))
+                         text="У тебя уже есть запись на {}. "
+                              "Чтобы записаться отмени ранее сделанную запись.".format(date),
+                         reply_markup=ReplyKeyboardRemove())
     else:
-        user = User.objects.get(pk=user_id)
-        time_slot.people.add(user)
-        time_slot.save()
         bot.send_message(chat_id=update.message.chat_id,
-                         text="Ok, записал на {} {} {}".format(
-                             place, date, time.strftime("%H:%M")),
+                         text="У тебя уже достигнут лимит записей на эту неделю. "
+                              "Сначала отмени другую запись.",
                          reply_markup=ReplyKeyboardRemove())
     return ConversationHandler.END
 
@@ -358,14 +366,13 @@ def ask_unsubscribe(update, context):
     user_id = update.effective_user.id
     user_subs = TimeSlot.objects.filter(people__id=user_id,
                                         date__gt=dt.date.today())
+    user_subs = list(user_subs.values_list('pk', 'place__name', 'date', 'time'))
     bot = context.bot
     if user_subs:
         keyboard = [[
-            InlineKeyboardButton("{} {} {}".format(user_sub.place.name,
-                                                   user_sub.date,
-                                                   user_sub.time.strftime("%H:%M")),
-                                 callback_data=user_sub.pk)
-        ] for user_sub in user_subs]
+            InlineKeyboardButton("{} {} {}".format(place, date, time.strftime("%H:%M")),
+                                 callback_data=pk)
+        ] for pk, place, date, time in user_subs]
         reply_markup = ReplyKeyboardWithCancel(keyboard, one_time_keyboard=True)
         bot.send_message(chat_id=update.message.chat_id,
                          text="Какое отменяем?",
@@ -425,7 +432,7 @@ def unsubscribe(update, context):
 
         user_id = update.effective_user.id
         time_slot = TimeSlot.objects.get(date=date, place__name=place, time=time)
-        time_slot.people.remove(User.objects.get(pk=user_id))
+        time_slot.people.remove(user_id)
         bot.send_message(chat_id=update.message.chat_id,
                          text="Ok, удалил запись на {} {} {}".format(place, date, time),
                          reply_markup=ReplyKeyboardRemove())
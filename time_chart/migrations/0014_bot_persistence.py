@@ -0,0 +1,56 @@
+# Generated by Django 3.1.6 on 2026-10-18 14:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('time_chart', '0013_user_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BotConversation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=80)),
+                ('key', models.CharField(max_length=100)),
+                ('state', models.IntegerField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BotData',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('user', 'user'), ('chat', 'chat')], max_length=4)),
+                ('key', models.BigIntegerField()),
+                ('data', models.BinaryField()),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='timeslot',
+            name='allowed_groups',
+            field=models.ManyToManyField(blank=True, default=None, limit_choices_to={'is_active': True}, to='time_chart.Group'),
+        ),
+        migrations.AlterField(
+            model_name='timeslot',
+            name='people',
+            field=models.ManyToManyField(blank=True, limit_choices_to={'is_active': True}, to='time_chart.User'),
+        ),
+        migrations.AlterField(
+            model_name='timeslot',
+            name='place',
+            field=models.ForeignKey(limit_choices_to={'is_active': True}, null=True, on_delete=django.db.models.deletion.SET_NULL, to='time_chart.place'),
+        ),
+        migrations.AddConstraint(
+            model_name='botdata',
+            constraint=models.UniqueConstraint(fields=('kind', 'key'), name='bot_data_kind_key'),
+        ),
+        migrations.AddConstraint(
+            model_name='botconversation',
+            constraint=models.UniqueConstraint(fields=('name', 'key'), name='bot_conversation_name_key'),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 3.1.6 on 2026-10-18 14:11
+
+from collections import Counter
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def count_bookings(apps, schema_editor):
+    TimeSlot = apps.get_model('time_chart', 'TimeSlot')
+    WeeklyBookings = apps.get_model('time_chart', 'WeeklyBookings')
+    DailyBookings = apps.get_model('time_chart', 'DailyBookings')
+    weekly, daily = Counter(), Counter()
+    for user_id, date in TimeSlot.people.through.objects.values_list('user_id', 'timeslot__date').iterator():
+        year, week, _ = date.isocalendar()
+        weekly[(user_id, year, week)] += 1
+        daily[(user_id, date)] += 1
+    WeeklyBookings.objects.bulk_create(
+        [WeeklyBookings(user_id=user_id, year=year, week=week, bookings=bookings)
+         for (user_id, year, week), bookings in weekly.items()],
+        batch_size=1000)
+    DailyBookings.objects.bulk_create(
+        [DailyBookings(user_id=user_id, date=date, bookings=bookings)
+         for (user_id, date), bookings in daily.items()],
+        batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('time_chart', '0014_bot_persistence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WeeklyBookings',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.PositiveSmallIntegerField()),
+                ('week', models.PositiveSmallIntegerField()),
+                ('bookings', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='time_chart.user')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DailyBookings',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('bookings', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='time_chart.user')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='weeklybookings',
+            constraint=models.UniqueConstraint(fields=('user', 'year', 'week'), name='weekly_bookings_user_year_week_key'),
+        ),
+        migrations.AddConstraint(
+            model_name='dailybookings',
+            constraint=models.UniqueConstraint(fields=('user', 'date'), name='daily_bookings_user_date_key'),
+        ),
+        migrations.RunPython(count_bookings, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 3.1.6 on 2026-10-18 14:12
+
+from django.db import migrations, models
+
+# the auto-created through table is only indexed by (timeslot_id, user_id),
+# bookings of a user (quota checks, unsubscribe, reports) start from user_id
+PEOPLE_USER_INDEX = models.Index(fields=['user', 'timeslot'], name='time_slot_people_user_slot')
+
+
+def add_people_index(apps, schema_editor):
+    through = apps.get_model('time_chart', 'TimeSlot').people.through
+    schema_editor.add_index(through, PEOPLE_USER_INDEX)
+
+
+def remove_people_index(apps, schema_editor):
+    through = apps.get_model('time_chart', 'TimeSlot').people.through
+    schema_editor.remove_index(through, PEOPLE_USER_INDEX)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('time_chart', '0015_booking_counters'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='timeslot',
+            index=models.Index(condition=models.Q(open=True), fields=['place', 'date'], name='time_slot_open_place_date'),
+        ),
+        migrations.AddIndex(
+            model_name='timeslot',
+            index=models.Index(fields=['date', 'time'], name='time_slot_date_time'),
+        ),
+        migrations.RunPython(add_people_index, reverse_code=remove_people_index),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.1.6 on 2026-10-18 14:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('time_chart', '0017_export_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduleVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='exportjob',
+            name='cache_key',
+            field=models.CharField(blank=True, db_index=True, max_length=40),
+        ),
+    ]
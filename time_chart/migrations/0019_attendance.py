@@ -0,0 +1,45 @@
+# Generated by Django 3.1.6 on 2026-10-18 14:26
+
+import datetime as dt
+
+from django.db import migrations, models
+from django.db.models import Count
+import django.db.models.deletion
+
+
+def count_attendance(apps, schema_editor):
+    TimeSlot = apps.get_model('time_chart', 'TimeSlot')
+    Attendance = apps.get_model('time_chart', 'Attendance')
+    AttendanceRollup = apps.get_model('time_chart', 'AttendanceRollup')
+    today = dt.date.today()
+    visits = TimeSlot.people.through.objects.filter(timeslot__date__lt=today).values(
+        'user_id').annotate(visits=Count('id')).values_list('user_id', 'visits')
+    Attendance.objects.bulk_create(
+        [Attendance(user_id=user_id, visits=count) for user_id, count in visits.iterator()],
+        batch_size=1000)
+    AttendanceRollup.objects.create(pk=1, date=today)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('time_chart', '0018_schedule_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Attendance',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='time_chart.user')),
+                ('visits', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AttendanceRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+            ],
+        ),
+        migrations.RunPython(count_attendance, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.1.6 on 2026-10-18 14:28
+
+import datetime
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('time_chart', '0019_attendance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduleTemplate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('weekday', models.PositiveSmallIntegerField(choices=[(0, 'Понедельник'), (1, 'Вторник'), (2, 'Среда'), (3, 'Четверг'), (4, 'Пятница'), (5, 'Суббота'), (6, 'Воскресенье')])),
+                ('time', models.TimeField()),
+                ('open', models.BooleanField(default=True)),
+                ('limit', models.PositiveSmallIntegerField(default=8)),
+                ('valid_from', models.DateField(default=datetime.date.today)),
+                ('valid_until', models.DateField(blank=True, null=True)),
+                ('is_active', models.BooleanField(default=True)),
+                ('materialized_until', models.DateField(blank=True, editable=False, null=True)),
+                ('groups', models.ManyToManyField(blank=True, limit_choices_to={'is_active': True}, to='time_chart.Group')),
+                ('place', models.ForeignKey(limit_choices_to={'is_active': True}, on_delete=django.db.models.deletion.CASCADE, to='time_chart.place')),
+            ],
+        ),
+    ]
@@ -0,0 +1,44 @@
+from django.db import migrations, models
+
+# the admin autocomplete looks users up by a case insensitive prefix of these
+SEARCH_FIELDS = ('last_name', 'first_name', 'nick_name')
+
+
+def index_name(field):
+    return f'user_{field}_search'
+
+
+def add_search_indexes(apps, schema_editor):
+    User = apps.get_model('time_chart', 'User')
+    table = schema_editor.quote_name(User._meta.db_table)
+    for field in SEARCH_FIELDS:
+        name = schema_editor.quote_name(index_name(field))
+        column = schema_editor.quote_name(field)
+        if schema_editor.connection.vendor == 'postgresql':
+            # istartswith is UPPER(column::text) LIKE UPPER(prefix)
+            schema_editor.execute(f'CREATE INDEX {name} ON {table} (UPPER({column}::text) text_pattern_ops)')
+        elif schema_editor.connection.vendor == 'sqlite':
+            # LIKE is case insensitive, SQLite uses a NOCASE index for a prefix
+            schema_editor.execute(f'CREATE INDEX {name} ON {table} ({column} COLLATE NOCASE)')
+        else:
+            schema_editor.add_index(User, models.Index(fields=[field], name=index_name(field)))
+
+
+def remove_search_indexes(apps, schema_editor):
+    User = apps.get_model('time_chart', 'User')
+    for field in SEARCH_FIELDS:
+        if schema_editor.connection.vendor in ('postgresql', 'sqlite'):
+            schema_editor.execute(f'DROP INDEX {schema_editor.quote_name(index_name(field))}')
+        else:
+            schema_editor.remove_index(User, models.Index(fields=[field], name=index_name(field)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('time_chart', '0020_schedule_templates'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_search_indexes, reverse_code=remove_search_indexes),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 3.1.6 on 2026-10-18 14:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def drop_finished_jobs(apps, schema_editor):
+    # the files are in the removed column, the exports are built again on demand
+    ExportJob = apps.get_model('time_chart', 'ExportJob')
+    ExportJob.objects.filter(status='done').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('time_chart', '0022_archive'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_finished_jobs, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='exportjob',
+            name='result',
+        ),
+        migrations.AddField(
+            model_name='exportjob',
+            name='size',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.CreateModel(
+            name='ExportFilePart',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='file_parts', to='time_chart.exportjob')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='exportfilepart',
+            constraint=models.UniqueConstraint(fields=('job', 'index'), name='export_file_part_job_index'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.1.6 on 2026-10-18 14:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('time_chart', '0023_export_file_parts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BroadcastJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('running', 'running'), ('done', 'done'), ('failed', 'failed')], default='pending', max_length=7)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(null=True)),
+                ('finished', models.DateTimeField(null=True)),
+                ('error', models.TextField(blank=True)),
+                ('text', models.TextField()),
+                ('chat_ids', models.JSONField()),
+                ('sent', models.PositiveIntegerField(null=True)),
+                ('failed', models.JSONField(null=True)),
+                ('retries', models.PositiveIntegerField(null=True)),
+                ('elapsed', models.FloatField(null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='broadcastjob',
+            index=models.Index(fields=['status', 'created'], name='broadcast_job_status_created'),
+        ),
+    ]
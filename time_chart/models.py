@@ -1,18 +1,16 @@
-import aiohttp
-import asyncio
-import urllib.parse
+import datetime as dt
+import enum
+import hashlib
+import json
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, Exists, F, OuterRef, Sum
+from django.utils import timezone
 from model_utils import FieldTracker
 
-from time_chart.management.commands import config
+from time_chart.management.commands.config import WEEKDAYS
 
-
-async def send_notifications(chat_ids):
-    async with aiohttp.ClientSession() as session:
-        msg = urllib.parse.quote("Для вашей группы расписание открыто для записи на занятия.")
-        for chat_id in chat_ids:
-            await session.get(f'https://api.telegram.org/bot{config.BOT_TOKEN}/sendMessage?chat_id={chat_id}&text={msg}')
+SIGNUP_OPEN_MESSAGE = "Для вашей группы расписание открыто для записи на занятия."
 
 
 class Group(models.Model):
@@ -28,18 +26,14 @@ class Group(models.Model):
         return self.name
 
     def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        if self.pk and not self.tracker.previous('allow_signup') and self.allow_signup:
-            chat_ids = [u.bot_chat_id for u in self.user_set.filter(is_active=True).all()]
-
-            try:
-                loop = asyncio.get_event_loop()
-            except RuntimeError:
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-
-            task = send_notifications(chat_ids)
-            loop.run_until_complete(task)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if self.pk and not self.tracker.previous('allow_signup') and self.allow_signup:
+                chat_ids = list(self.user_set.filter(is_active=True)
+                                .exclude(bot_chat_id=None)
+                                .values_list('bot_chat_id', flat=True))
+                # sent by the broadcast_worker, queued only together with the change
+                BroadcastJob.objects.create(text=SIGNUP_OPEN_MESSAGE, chat_ids=chat_ids)
 
 
 class User(models.Model):
@@ -58,6 +52,16 @@ class User(models.Model):
             return self.nick_name
 
 
+def start_of_the_week(day):
+    """First day of the booking week containing ``day``
+
+    On sunday the current week is over already, so the next one is returned.
+    """
+    if day.weekday() == 6:  # 6 == sunday
+        return day + dt.timedelta(days=1)
+    return day - dt.timedelta(days=day.weekday())
+
+
 # *********** Time Schedule models ***************************
 
 class Place(models.Model):
@@ -68,6 +72,26 @@ class Place(models.Model):
         return self.name
 
 
+class Reservation(enum.Enum):
+    """Outcome of :meth:`TimeSlot.reserve`"""
+    BOOKED = 'booked'
+    FULL = 'full'
+    CLOSED = 'closed'
+    OVER_QUOTA = 'over_quota'
+    DAY_TAKEN = 'day_taken'
+
+
+class TimeSlotQuerySet(models.QuerySet):
+
+    def for_group(self, group_id):
+        """Slots without group restriction or with the group allowed"""
+        allowed_groups = TimeSlot.allowed_groups.through.objects.filter(timeslot_id=OuterRef('pk'))
+        return self.filter(~Exists(allowed_groups) | Exists(allowed_groups.filter(group_id=group_id)))
+
+    def with_free_seats(self):
+        return self.annotate(people_count=Count('people')).annotate(free_seats=F('limit') - F('people_count'))
+
+
 class TimeSlot(models.Model):
 
     class Meta:
@@ -76,6 +100,13 @@ class TimeSlot(models.Model):
                 fields=['place', 'date', 'time'],
                 name='time_slot_place_date_time_key')
         ]
+        indexes = [
+            # open future slots of a place (bot sign up)
+            models.Index(fields=['place', 'date'], condition=models.Q(open=True),
+                         name='time_slot_open_place_date'),
+            # date ranges ordered by time (admin changelist, exports)
+            models.Index(fields=['date', 'time'], name='time_slot_date_time'),
+        ]
 
     place = models.ForeignKey(Place, null=True, on_delete=models.SET_NULL, limit_choices_to={'is_active': True})
     date = models.DateField()
@@ -87,5 +118,435 @@ class TimeSlot(models.Model):
 
     allowed_groups = models.ManyToManyField(Group, default=None, blank=True, limit_choices_to={'is_active': True})
 
+    objects = TimeSlotQuerySet.as_manager()
+
+    tracker = FieldTracker(fields=['date'])
+
+    def __str__(self):
+        return f"{self.place} - {self.date} {self.time} "
+
+    def reserve(self, user, check_quota=True):
+        """Book ``user`` into the time slot if it is still possible
+
+        The check of the slot capacity, the group limit for the ISO week of
+        the slot and the one-booking-per-day rule and the insert itself are done in one
+        transaction with the slot and the user rows locked, so concurrent
+        sign ups can neither overbook the slot nor exceed the user quota.
+        Quota checks are skipped with ``check_quota=False`` (admins).
+        Returns a :class:`Reservation` member.
+        """
+        with transaction.atomic():
+            slot = TimeSlot.objects.select_for_update().get(pk=self.pk)
+            user = User.objects.select_for_update().get(pk=user.pk)
+            group = user.group
+
+            if not slot.open or not user.is_active or group is None or not group.allow_signup:
+                return Reservation.CLOSED
+            allowed_groups = set(slot.allowed_groups.values_list('pk', flat=True))
+            if allowed_groups and group.pk not in allowed_groups:
+                return Reservation.CLOSED
+
+            if check_quota:
+                if DailyBookings.of(user.pk, slot.date):
+                    return Reservation.DAY_TAKEN
+                if WeeklyBookings.of(user.pk, slot.date) >= group.week_limit:
+                    return Reservation.OVER_QUOTA
+
+            if slot.people.count() >= slot.limit:
+                return Reservation.FULL
+
+            slot.people.add(user)
+        return Reservation.BOOKED
+
+
+class WeeklyBookings(models.Model):
+    """Number of time slots a user is booked into in an ISO week
+
+    Maintained together with the ``TimeSlot.people`` rows (see
+    ``time_chart.signals``), so the week limit is checked with one lookup.
+    """
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'year', 'week'],
+                name='weekly_bookings_user_year_week_key')
+        ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    year = models.PositiveSmallIntegerField()
+    week = models.PositiveSmallIntegerField()
+    bookings = models.IntegerField(default=0)
+
+    @classmethod
+    def of(cls, user_id, day):
+        """Bookings of the user in the ISO week of ``day``"""
+        year, week, _ = day.isocalendar()
+        return cls.objects.filter(user_id=user_id, year=year, week=week).values_list(
+            'bookings', flat=True).first() or 0
+
+
+class DailyBookings(models.Model):
+    """Number of time slots a user is booked into on a date"""
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'date'],
+                name='daily_bookings_user_date_key')
+        ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    date = models.DateField()
+    bookings = models.IntegerField(default=0)
+
+    @classmethod
+    def of(cls, user_id, day):
+        return cls.objects.filter(user_id=user_id, date=day).values_list(
+            'bookings', flat=True).first() or 0
+
+
+class AttendanceRollup(models.Model):
+    """Date up to which (excluding) the past bookings are in ``Attendance``
+
+    The table holds a single row moved forward by the ``rollup_attendance``
+    command.
+    """
+
+    date = models.DateField()
+
+    @classmethod
+    def until(cls):
+        return cls.objects.filter(pk=1).values_list('date', flat=True).first()
+
+
+class Attendance(models.Model):
+    """Number of classes a user had before ``AttendanceRollup.until()``
+
+    The bookings of the days since then up to yesterday are added from
+    ``DailyBookings`` when the counter is read (see ``visits_of``), changes
+    of the bookings of rolled up days are applied by ``count_bookings``.
+    """
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True)
+    visits = models.IntegerField(default=0)
+
+    @classmethod
+    def visits_of(cls, user_ids):
+        """``{user id: number of classes before today}`` of the users, ``user_ids``
+        can be a list or a queryset of ids"""
+        visits = dict(cls.objects.filter(user_id__in=user_ids).values_list('user_id', 'visits'))
+        recent = DailyBookings.objects.filter(
+            user_id__in=user_ids,
+            date__gte=AttendanceRollup.until() or dt.date.min,
+            date__lt=dt.date.today(),
+        ).values('user_id').annotate(visits=Sum('bookings')).values_list('user_id', 'visits')
+        for user_id, count in recent:
+            visits[user_id] = visits.get(user_id, 0) + count
+        return visits
+
+    @classmethod
+    def add(cls, user_id, delta):
+        cls.objects.bulk_create([cls(user_id=user_id)], ignore_conflicts=True)
+        cls.objects.filter(user_id=user_id).update(visits=F('visits') + delta)
+
+
+def count_bookings(bookings, delta):
+    """Add ``delta`` to the counters of the ``(user id, date)`` bookings"""
+    bookings = list(bookings)
+    for user_id, day in bookings:
+        year, week, _ = day.isocalendar()
+        for model, key in ((WeeklyBookings, dict(user_id=user_id, year=year, week=week)),
+                           (DailyBookings, dict(user_id=user_id, date=day))):
+            # create the counter row if missing without racing a concurrent insert
+            model.objects.bulk_create([model(**key)], ignore_conflicts=True)
+            model.objects.filter(**key).update(bookings=F('bookings') + delta)
+
+    # only the admin changes bookings of the past days
+    today = dt.date.today()
+    past = [(user_id, day) for user_id, day in bookings if day < today]
+    if past:
+        until = AttendanceRollup.until()
+        for user_id, day in past:
+            if until is not None and day < until:
+                Attendance.add(user_id, delta)
+
+
+# *********** Archive ***************************
+
+class ArchivedTimeSlot(models.Model):
+    """Past time slot moved out of ``TimeSlot`` by the ``archive_time_slots``
+    command, under its original id"""
+
+    id = models.IntegerField(primary_key=True)
+    place = models.ForeignKey(Place, null=True, on_delete=models.SET_NULL, related_name='+')
+    date = models.DateField()
+    time = models.TimeField()
+
     def __str__(self):
         return f"{self.place} - {self.date} {self.time} "
+
+
+class ArchivedBooking(models.Model):
+    """Booking of an archived time slot, the ``TimeSlot.people`` row it replaces
+
+    The field names are the ones of the people through table, so the same
+    lookups read both tables (see ``all_bookings``).
+    """
+
+    timeslot = models.ForeignKey(ArchivedTimeSlot, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+
+
+def all_bookings(fields, **filters):
+    """``fields`` of the bookings of the time slots and of the archived ones,
+    one UNION ALL query that can still be ordered"""
+    hot = TimeSlot.people.through.objects.filter(**filters).values_list(*fields)
+    cold = ArchivedBooking.objects.filter(**filters).values_list(*fields)
+    return hot.union(cold, all=True)
+
+
+class ScheduleTemplate(models.Model):
+    """Weekly recurring time slot
+
+    The ``materialize_schedule`` command creates the time slots of the
+    templates for the coming days, ``materialized_until`` is the last date
+    it covered, so slots removed in the admin are not created again.
+    """
+
+    WEEKDAY_CHOICES = tuple(enumerate(WEEKDAYS))
+
+    place = models.ForeignKey(Place, on_delete=models.CASCADE, limit_choices_to={'is_active': True})
+    weekday = models.PositiveSmallIntegerField(choices=WEEKDAY_CHOICES)
+    time = models.TimeField()
+    open = models.BooleanField(default=True)
+    limit = models.PositiveSmallIntegerField(default=8)
+    groups = models.ManyToManyField(Group, blank=True, limit_choices_to={'is_active': True})
+    valid_from = models.DateField(default=dt.date.today)
+    valid_until = models.DateField(null=True, blank=True)
+    is_active = models.BooleanField(default=True)
+    materialized_until = models.DateField(null=True, blank=True, editable=False)
+
+    def __str__(self):
+        return f"{self.place} - {self.get_weekday_display()} {self.time}"
+
+    def dates(self, start, end):
+        """Dates of the template from ``start`` to ``end`` inclusive"""
+        start = max(start, self.valid_from)
+        if self.valid_until is not None:
+            end = min(end, self.valid_until)
+        date = start + dt.timedelta(days=(self.weekday - start.weekday()) % 7)
+        while date <= end:
+            yield date
+            date += dt.timedelta(days=7)
+
+
+# *********** Bot persistence models ***************************
+
+class BotData(models.Model):
+    """Pickled ``user_data``/``chat_data`` of one bot user or chat"""
+
+    USER, CHAT = 'user', 'chat'
+    KIND_CHOICES = ((USER, 'user'), (CHAT, 'chat'))
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['kind', 'key'],
+                name='bot_data_kind_key')
+        ]
+
+    kind = models.CharField(max_length=4, choices=KIND_CHOICES)
+    key = models.BigIntegerField()
+    data = models.BinaryField()
+    updated = models.DateTimeField(auto_now=True)
+
+
+class BotConversation(models.Model):
+    """State of one conversation of a ``ConversationHandler``"""
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['name', 'key'],
+                name='bot_conversation_name_key')
+        ]
+
+    name = models.CharField(max_length=80)
+    key = models.CharField(max_length=100)
+    state = models.IntegerField()
+
+
+# *********** Admin exports ***************************
+
+class Version(models.Model):
+    """Counter of the changes of some data, the table holds a single row
+
+    The signals bump it for the changes done through the models (see
+    ``time_chart.signals``), bulk queryset updates have to call ``bump``
+    themselves.
+    """
+
+    class Meta:
+        abstract = True
+
+    version = models.BigIntegerField(default=0)
+
+    @classmethod
+    def current(cls):
+        return cls.objects.filter(pk=1).values_list('version', flat=True).first() or 0
+
+    @classmethod
+    def bump(cls):
+        if not cls.objects.filter(pk=1).update(version=F('version') + 1):
+            cls.objects.bulk_create([cls(pk=1, version=1)], ignore_conflicts=True)
+
+
+class ScheduleVersion(Version):
+    """Counter bumped on every change of the data the exports show"""
+
+
+class UserVersion(Version):
+    """Counter bumped on every change of the users or their groups (admin autocomplete)"""
+
+
+class Job(models.Model):
+    """Work done by a worker process
+
+    The table is the queue: a pending job is inserted, a worker claims it
+    with a conditional update (see ``claim``), does the work and stores the
+    outcome on the row.
+    """
+
+    PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+    STATUS_CHOICES = ((PENDING, 'pending'), (RUNNING, 'running'), (DONE, 'done'), (FAILED, 'failed'))
+
+    class Meta:
+        abstract = True
+
+    status = models.CharField(max_length=7, choices=STATUS_CHOICES, default=PENDING)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+    error = models.TextField(blank=True)
+
+    @property
+    def is_finished(self):
+        return self.status in (self.DONE, self.FAILED)
+
+    @classmethod
+    def claim(cls, timeout):
+        """Take the oldest pending job, or a running one started more than
+        ``timeout`` seconds ago by a worker that died, returns None if there
+        is nothing to do"""
+        now = timezone.now()
+        candidates = cls.objects.filter(
+            models.Q(status=cls.PENDING)
+            | models.Q(status=cls.RUNNING, started__lt=now - dt.timedelta(seconds=timeout))
+        ).order_by('created').values_list('pk', 'status', 'started')[:10]
+        for pk, status, started in candidates:
+            # only one worker updates the row from the state it has seen
+            if cls.objects.filter(pk=pk, status=status, started=started).update(status=cls.RUNNING, started=now):
+                return cls.objects.get(pk=pk)
+        return None
+
+
+class ExportJob(Job):
+    """Admin export built by the ``export_worker`` command
+
+    The worker stores the file in ``ExportFilePart`` rows.
+    The table is also the cache of the files: a job is reused for the same
+    ``cache_key`` (see ``cache_key_for``) instead of queueing a new one.
+    """
+
+    SCHEDULE, REPORT = 'schedule', 'report'
+    KIND_CHOICES = ((SCHEDULE, 'schedule'), (REPORT, 'user report'))
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created'], name='export_job_status_created'),
+        ]
+
+    kind = models.CharField(max_length=8, choices=KIND_CHOICES)
+    # ids of the exported time slots or users, null for the complete schedule
+    selection = models.JSONField(null=True)
+    size = models.PositiveIntegerField(null=True)  # bytes of the file
+    cache_key = models.CharField(max_length=40, blank=True, db_index=True)
+
+    def __str__(self):
+        return f'{self.get_kind_display()} #{self.pk}'
+
+    @classmethod
+    def cache_key_for(cls, kind, selection):
+        """Hash of the export kind, the selection and the schedule version
+
+        The date is part of the key as the exports count the past classes.
+        """
+        payload = json.dumps([
+            kind,
+            sorted(selection) if selection is not None else None,
+            ScheduleVersion.current(),
+            dt.date.today().isoformat(),
+        ])
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+    @classmethod
+    def queue(cls, kind, selection=None):
+        """The job building the export, an existing one if the data did not change"""
+        cache_key = cls.cache_key_for(kind, selection)
+        job = cls.objects.filter(cache_key=cache_key).exclude(status=cls.FAILED).only('pk').order_by('-created').first()
+        if job is None:
+            job = cls.objects.create(kind=kind, selection=selection, cache_key=cache_key)
+        return job
+
+    @property
+    def filename(self):
+        return f'{self.kind}.xlsx'
+
+    def parts(self):
+        """Content of the file, one part (database row) at a time"""
+        parts = self.file_parts.order_by('index').values_list('data', flat=True)
+        for data in parts.iterator(chunk_size=1):
+            yield bytes(data)
+
+
+class ExportFilePart(models.Model):
+    """EXPORT_FILE_PART_SIZE bytes of the file of an ``ExportJob``
+
+    The file is kept in the database, shared by the worker and the web
+    processes, in parts, so neither of them holds the whole file in memory.
+    """
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['job', 'index'],
+                name='export_file_part_job_index')
+        ]
+
+    job = models.ForeignKey(ExportJob, on_delete=models.CASCADE, related_name='file_parts')
+    index = models.PositiveIntegerField()
+    data = models.BinaryField()
+
+
+class BroadcastJob(Job):
+    """Message to many chats sent by the ``broadcast_worker`` command
+
+    The outcome of the delivery (see ``broadcast.DeliveryReport``) is kept
+    on the job for the admin.
+    """
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created'], name='broadcast_job_status_created'),
+        ]
+
+    text = models.TextField()
+    chat_ids = models.JSONField()
+    sent = models.PositiveIntegerField(null=True)
+    failed = models.JSONField(null=True)  # chat id -> last error
+    retries = models.PositiveIntegerField(null=True)
+    elapsed = models.FloatField(null=True)  # seconds
+
+    def __str__(self):
+        return f'broadcast #{self.pk}'
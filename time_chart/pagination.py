@@ -0,0 +1,135 @@
+"""Keyset pagination of the time slot changelist
+
+Instead of a page number (COUNT plus OFFSET) the links carry the
+(date, time, place) of the last (``after``) or the first (``before``) slot
+shown and the next page starts right behind it, so every page costs the
+same on the (date, time) index wherever it is. ``from`` jumps to the first
+slot of a date. The number of slots is only estimated.
+
+A changelist sorted by a column header uses the default paginator.
+"""
+import datetime as dt
+import json
+
+from django.contrib.admin.views.main import ORDER_VAR, PAGE_VAR, ChangeList
+from django.db import DatabaseError, connections, transaction
+from django.db.models import F, Q
+
+from time_chart.management.commands.tools import logger
+
+AFTER_VAR, BEFORE_VAR, FROM_VAR = 'after', 'before', 'from'
+KEYSET_PARAMS = (AFTER_VAR, BEFORE_VAR, FROM_VAR)
+# AutoField ids are 32 bit integers
+MAX_ID = 2 ** 31
+
+
+def estimated_count(queryset):
+    """Planner estimate of the number of rows on PostgreSQL, the exact number
+    elsewhere or if the plan cannot be read
+
+    ``QuerySet.explain`` returns the repr of the JSON plan, so the EXPLAIN
+    runs on a cursor of its own.
+    """
+    queryset = queryset.order_by()
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        try:
+            sql, params = queryset.query.sql_with_params()
+            # a savepoint, so the count still runs if the EXPLAIN fails in a transaction
+            with transaction.atomic(using=queryset.db), connection.cursor() as cursor:
+                cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+                plan = cursor.fetchone()[0]
+            # psycopg2 decodes the json column unless the type is not registered
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            return int(plan[0]['Plan']['Plan Rows'])
+        except (DatabaseError, ValueError, LookupError, TypeError):
+            logger.exception('Reading the plan of the time slot changelist failed')
+    return queryset.count()
+
+
+def encode_cursor(slot):
+    return f'{slot.date.isoformat()}_{slot.time.isoformat()}_{slot.place_id or ""}'
+
+
+def decode_cursor(value):
+    """``(date, time, place id)`` of a cursor, ValueError if it was tampered with"""
+    date, time, place_id = value.split('_')
+    place_id = int(place_id) if place_id else None
+    if place_id is not None and not 0 < place_id < MAX_ID:
+        raise ValueError(f'Place id out of range: {place_id}')
+    return dt.date.fromisoformat(date), dt.time.fromisoformat(time), place_id
+
+
+def after(date, time, place_id):
+    """Slots behind the key in the (date, time, place with nulls first) order"""
+    q = Q(date__gt=date) | Q(date=date, time__gt=time)
+    if place_id is None:
+        return q | Q(date=date, time=time, place__isnull=False)
+    return q | Q(date=date, time=time, place_id__gt=place_id)
+
+
+def before(date, time, place_id):
+    q = Q(date__lt=date) | Q(date=date, time__lt=time)
+    if place_id is None:
+        return q
+    return q | Q(date=date, time=time, place_id__lt=place_id) | Q(date=date, time=time, place__isnull=True)
+
+
+class KeysetChangeList(ChangeList):
+
+    def get_filters_params(self, params=None):
+        # the cursor is neither a filter nor kept in the sort and filter links
+        for key in KEYSET_PARAMS:
+            self.params.pop(key, None)
+        lookup_params = super().get_filters_params(params)
+        for key in KEYSET_PARAMS:
+            lookup_params.pop(key, None)
+        return lookup_params
+
+    def get_results(self, request):
+        if ORDER_VAR in self.params:
+            self.keyset = None
+            return super().get_results(request)
+
+        ascending = ('date', 'time', F('place_id').asc(nulls_first=True))
+        descending = ('-date', '-time', F('place_id').desc(nulls_last=True))
+        per_page = self.list_per_page
+        try:
+            if BEFORE_VAR in request.GET:
+                key = decode_cursor(request.GET[BEFORE_VAR])
+                rows = list(self.queryset.filter(before(*key)).order_by(*descending)[:per_page + 1])
+                has_previous, has_next = len(rows) > per_page, True
+                rows = rows[:per_page][::-1]
+            else:
+                queryset = self.queryset
+                if AFTER_VAR in request.GET:
+                    queryset = queryset.filter(after(*decode_cursor(request.GET[AFTER_VAR])))
+                elif FROM_VAR in request.GET:
+                    queryset = queryset.filter(date__gte=dt.date.fromisoformat(request.GET[FROM_VAR]))
+                rows = list(queryset.order_by(*ascending)[:per_page + 1])
+                has_next = len(rows) > per_page
+                rows = rows[:per_page]
+                has_previous = bool(rows) and (AFTER_VAR in request.GET or FROM_VAR in request.GET) and \
+                    self.queryset.filter(before(rows[0].date, rows[0].time, rows[0].place_id)).exists()
+        except ValueError:
+            rows, has_previous, has_next = [], False, False
+
+        self.result_count = estimated_count(self.queryset)
+        self.show_full_result_count = False
+        self.full_result_count = None
+        self.show_admin_actions = True
+        self.result_list = rows
+        self.can_show_all = False
+        self.show_all = False
+        self.multi_page = has_previous or has_next
+        self.paginator = None
+        remove = (PAGE_VAR,) + KEYSET_PARAMS
+        self.keyset = {
+            'first': self.get_query_string(remove=remove),
+            'previous': rows and has_previous and self.get_query_string(
+                {BEFORE_VAR: encode_cursor(rows[0])}, remove=remove),
+            'next': rows and has_next and self.get_query_string(
+                {AFTER_VAR: encode_cursor(rows[-1])}, remove=remove),
+            'from': request.GET.get(FROM_VAR, ''),
+        }
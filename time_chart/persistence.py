@@ -0,0 +1,170 @@
+"""Bot persistence stored in the database
+
+Every user (chat) has its own ``BotData`` row with the pickled ``user_data``
+(``chat_data``) and every conversation its own ``BotConversation`` row.
+Nothing is read at startup, rows are loaded on first access, and a row is
+written only when its content changed since it was loaded or last saved, so
+the cost of an update does not depend on the number of users and a broken
+row affects a single user only.
+
+Several processes (web workers, the polling worker) handle the updates of
+the same user, so ``refresh`` reloads the data and the conversation states
+of the user and the chat of an update before it is handled. The states are
+kept in memory by the conversation handlers and written through by
+``update_conversation``. Conversations per message are not supported.
+"""
+import json
+import pickle
+import threading
+from collections import defaultdict
+from functools import reduce
+from operator import or_
+
+from django.db.models import Q
+from django.utils import timezone
+from telegram.ext import BasePersistence
+
+from time_chart.management.commands.tools import logger
+from time_chart.models import BotConversation, BotData
+
+
+class _LazyData(defaultdict):
+    """``defaultdict(dict)`` loading missing entries from the database"""
+
+    def __init__(self, persistence, kind):
+        super().__init__(dict)
+        self._persistence = persistence
+        self._kind = kind
+
+    def __missing__(self, key):
+        value = self._persistence.load_data(self._kind, key)
+        self[key] = value
+        return value
+
+
+def _upsert(model, lookup, **values):
+    """Update the row of ``lookup`` or create it, even if another process
+    creates it at the same time"""
+    if not model.objects.filter(**lookup).update(**values):
+        model.objects.bulk_create([model(**lookup, **values)], ignore_conflicts=True)
+        model.objects.filter(**lookup).update(**values)
+
+
+def _conversation_keys(update):
+    """Keys of the conversations the update can belong to, see
+    ``ConversationHandler._get_key``"""
+    chat, user = update.effective_chat, update.effective_user
+    keys = []
+    if chat is not None:
+        keys.append((chat.id,))
+    if user is not None:
+        keys.append((user.id,))
+    if chat is not None and user is not None:
+        keys.append((chat.id, user.id))
+    return keys
+
+
+class DatabasePersistence(BasePersistence):
+
+    def __init__(self, store_user_data=True, store_chat_data=True):
+        super().__init__(store_user_data=store_user_data,
+                         store_chat_data=store_chat_data,
+                         store_bot_data=False)
+        self._saved = {}  # (kind, key) -> last loaded or saved pickle
+        self._lock = threading.Lock()
+        self._conversations = {}  # handler name -> conversation states
+
+    def get_user_data(self):
+        return _LazyData(self, BotData.USER)
+
+    def get_chat_data(self):
+        return _LazyData(self, BotData.CHAT)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        return self._conversations.setdefault(name, {})
+
+    def update_user_data(self, user_id, data):
+        self._save_data(BotData.USER, user_id, data)
+
+    def update_chat_data(self, chat_id, data):
+        self._save_data(BotData.CHAT, chat_id, data)
+
+    def update_bot_data(self, data):
+        pass
+
+    def update_conversation(self, name, key, new_state):
+        key = json.dumps(key)
+        if new_state is None:
+            BotConversation.objects.filter(name=name, key=key).delete()
+        else:
+            _upsert(BotConversation, dict(name=name, key=key), state=new_state)
+
+    def load_data(self, kind, key):
+        raw = BotData.objects.filter(kind=kind, key=key).values_list('data', flat=True).first()
+        return self._unpickle(kind, key, raw)
+
+    def refresh(self, dispatcher, update):
+        """Reload the data and the conversation states of the user and the
+        chat of the update, in place"""
+        self._refresh_conversations(update)
+        mappings = {}
+        if self.store_user_data and update.effective_user:
+            mappings[(BotData.USER, update.effective_user.id)] = dispatcher.user_data
+        if self.store_chat_data and update.effective_chat:
+            mappings[(BotData.CHAT, update.effective_chat.id)] = dispatcher.chat_data
+        if not mappings:
+            return
+        rows = BotData.objects.filter(
+            reduce(or_, (Q(kind=kind, key=key) for kind, key in mappings))).values_list('kind', 'key', 'data')
+        raws = {(kind, key): raw for kind, key, raw in rows}
+        for (kind, key), mapping in mappings.items():
+            data = self._unpickle(kind, key, raws.get((kind, key)))
+            current = mapping.get(key)
+            if current is None:
+                mapping[key] = data
+            else:
+                # the callback context of the update may hold the dict already
+                current.clear()
+                current.update(data)
+
+    def _refresh_conversations(self, update):
+        keys = _conversation_keys(update)
+        if not self._conversations or not keys:
+            return
+        rows = BotConversation.objects.filter(
+            name__in=self._conversations, key__in=[json.dumps(key) for key in keys],
+        ).values_list('name', 'key', 'state')
+        states = {(name, key): state for name, key, state in rows}
+        for name, conversations in self._conversations.items():
+            for key in keys:
+                state = states.get((name, json.dumps(key)))
+                if state is None:
+                    conversations.pop(key, None)
+                else:
+                    conversations[key] = state
+
+    def _unpickle(self, kind, key, raw):
+        with self._lock:
+            self._saved.pop((kind, key), None)
+        if raw is None:
+            return {}
+        raw = bytes(raw)
+        try:
+            data = pickle.loads(raw)
+        except Exception as e:
+            logger.error('Can not load bot %s data of %s: %s', kind, key, e)
+            return {}
+        with self._lock:
+            self._saved[(kind, key)] = raw
+        return data
+
+    def _save_data(self, kind, key, data):
+        raw = pickle.dumps(data)
+        with self._lock:
+            if self._saved.get((kind, key), pickle.dumps({})) == raw:
+                return
+            self._saved[(kind, key)] = raw
+        _upsert(BotData, dict(kind=kind, key=key), data=raw, updated=timezone.now())
@@ -0,0 +1,25 @@
+"""User profile of the update handled by the bot
+
+A sign up takes several updates and every handler needs the user together
+with the group. The user is fetched with its group in one query once per
+update and kept on the callback context of the update, so a handler always
+sees the current admin edits (deactivated users, closed groups).
+``TimeSlot.reserve`` re-reads the user, so the booking itself never relies
+on the profile.
+"""
+from time_chart.models import User
+
+
+def get_profile(update, context):
+    """User of the update with the group loaded, raises User.DoesNotExist"""
+    user_id = update.effective_user.id
+    profile = getattr(context, 'profile', None)
+    if profile is None or profile.pk != user_id:
+        profile = User.objects.select_related('group').get(pk=user_id)
+        context.profile = profile
+    return profile
+
+
+def invalidate(context):
+    """Drop the profile after the handler changed the user"""
+    context.profile = None
@@ -0,0 +1,103 @@
+"""Creation of many time slots at once
+
+Used by the admin "add time slots" form and by the schedule templates. The
+slots are inserted with a few bulk queries in one transaction; bulk inserts
+do not send the model signals, so the export version and the availability
+index are updated here.
+"""
+import datetime as dt
+from itertools import islice, product
+
+from django.db import IntegrityError, transaction
+
+from time_chart import availability
+from time_chart.management.commands.config import SCHEDULE_BATCH_SIZE
+from time_chart.models import ScheduleVersion, TimeSlot
+
+
+def insert_time_slots(slots):
+    """Create the slots among ``(place id, date, time, open, limit, group ids)``
+    that do not exist yet
+
+    Existing slots are left as they are. The insert fails as a whole if
+    another transaction added one of the slots in the meantime, then it is
+    repeated without that slot, so only the slots created here count and get
+    the groups. Returns the number of created slots.
+    """
+    slots = {(place_id, date, time): (open, limit, list(group_ids))
+             for place_id, date, time, open, limit, group_ids in slots}
+    if not slots:
+        return 0
+    dates = [date for _, date, _ in slots]
+    period = dict(place_id__in=set(place_id for place_id, _, _ in slots),
+                  date__range=(min(dates), max(dates)),
+                  time__in=set(time for _, _, time in slots))
+    with transaction.atomic():
+        existing = set(TimeSlot.objects.filter(**period).values_list('place_id', 'date', 'time'))
+        while True:
+            new = {key: value for key, value in slots.items() if key not in existing}
+            if not new:
+                return 0
+            try:
+                with transaction.atomic():
+                    TimeSlot.objects.bulk_create(
+                        [TimeSlot(place_id=place_id, date=date, time=time, open=open, limit=limit)
+                         for (place_id, date, time), (open, limit, _) in new.items()])
+                break
+            except IntegrityError:
+                added = set(TimeSlot.objects.filter(**period).values_list('place_id', 'date', 'time')) - existing
+                if added.isdisjoint(new):
+                    # the insert did not fail because of a slot added in the meantime
+                    raise
+                # the slots added by someone else in the meantime are left as they are
+                existing |= added
+        if any(group_ids for _, _, group_ids in new.values()):
+            through = TimeSlot.allowed_groups.through
+            rows = []
+            for pk, *key in TimeSlot.objects.filter(**period).values_list('pk', 'place_id', 'date', 'time'):
+                key = tuple(key)
+                if key in new:
+                    rows.extend(through(timeslot_id=pk, group_id=group_id) for group_id in new[key][2])
+            through.objects.bulk_create(rows)
+        transaction.on_commit(ScheduleVersion.bump)
+        transaction.on_commit(availability.index.clear)
+    return len(new)
+
+
+def create_time_slots(place_ids, dates, times, open, limit, group_ids=()):
+    """Create the slots of every place, date and time that do not exist yet"""
+    return insert_time_slots((place_id, date, time, open, limit, group_ids)
+                             for place_id, date, time in product(place_ids, dates, times))
+
+
+def materialize_templates(templates, end, start=None, batch_size=SCHEDULE_BATCH_SIZE):
+    """Create the missing slots of the active templates up to ``end``
+
+    Every template continues after its ``materialized_until`` (or from
+    ``start`` if given, from today at the earliest) and the slots are
+    inserted in batches of ``batch_size``. Returns the number of created slots.
+    """
+    templates = templates.filter(is_active=True)
+    today = dt.date.today()
+    slots = []
+    for template in templates.prefetch_related('groups'):
+        if start is not None:
+            first = start
+        elif template.materialized_until is not None:
+            first = template.materialized_until + dt.timedelta(days=1)
+        else:
+            first = today
+        group_ids = [group.pk for group in template.groups.all()]
+        slots.extend((template.place_id, date, template.time, template.open, template.limit, group_ids)
+                     for date in template.dates(max(first, today), end))
+    slots.sort(key=lambda slot: slot[1])
+
+    created = 0
+    slots = iter(slots)
+    while True:
+        batch = list(islice(slots, batch_size))
+        if not batch:
+            break
+        created += insert_time_slots(batch)
+    templates.exclude(materialized_until__gte=end).update(materialized_until=end)
+    return created
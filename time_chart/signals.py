@@ -0,0 +1,138 @@
+import threading
+from contextlib import contextmanager
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from time_chart import availability
+from time_chart.models import Group, Place, ScheduleVersion, TimeSlot, User, UserVersion, count_bookings
+
+
+@receiver(post_save, sender=TimeSlot)
+def time_slot_saved(sender, instance, **kwargs):
+    transaction.on_commit(partial(availability.index.refresh, [instance.pk]))
+
+
+@receiver(post_delete, sender=TimeSlot)
+def time_slot_deleted(sender, instance, **kwargs):
+    transaction.on_commit(partial(availability.index.discard, instance.pk))
+
+
+@receiver(m2m_changed, sender=TimeSlot.people.through)
+def time_slot_people_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'post_add' and not reverse:
+        # pk_set holds only the people who were not in the slot yet
+        transaction.on_commit(partial(availability.index.add_people, instance.pk, len(pk_set)))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        _refresh_slots(instance, reverse, pk_set)
+
+
+@receiver(m2m_changed, sender=TimeSlot.allowed_groups.through)
+def time_slot_groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        _refresh_slots(instance, reverse, pk_set)
+
+
+def _refresh_slots(instance, reverse, pk_set):
+    if not reverse:
+        transaction.on_commit(partial(availability.index.refresh, [instance.pk]))
+    elif pk_set:
+        transaction.on_commit(partial(availability.index.refresh, pk_set))
+    else:
+        # reverse clear does not report the affected slots
+        transaction.on_commit(availability.index.clear)
+
+
+# booking counters, updated in the transaction changing the people of a slot
+
+@receiver(m2m_changed, sender=TimeSlot.people.through)
+def count_time_slot_people(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('pre_add', 'pre_remove', 'pre_clear'):
+        instance._booking_changes = _bookings(instance, action, reverse, pk_set)
+    elif action == 'post_add':
+        count_bookings(instance.__dict__.pop('_booking_changes', ()), 1)
+    elif action in ('post_remove', 'post_clear'):
+        count_bookings(instance.__dict__.pop('_booking_changes', ()), -1)
+
+
+def _bookings(instance, action, reverse, pk_set):
+    """``(user id, date)`` pairs added or removed by the m2m change"""
+    if action == 'pre_add':
+        # pk_set holds only the new rows
+        if reverse:
+            return [(instance.pk, date) for date in
+                    TimeSlot.objects.filter(pk__in=pk_set).values_list('date', flat=True)]
+        return [(user_id, instance.date) for user_id in pk_set]
+
+    rows = TimeSlot.people.through.objects.all()
+    if reverse:
+        rows = rows.filter(user_id=instance.pk)
+        if pk_set is not None:
+            rows = rows.filter(timeslot_id__in=pk_set)
+    else:
+        rows = rows.filter(timeslot_id=instance.pk)
+        if pk_set is not None:
+            rows = rows.filter(user_id__in=pk_set)
+    return list(rows.values_list('user_id', 'timeslot__date'))
+
+
+_archiving = threading.local()
+
+
+@contextmanager
+def archiving():
+    """Time slots deleted in the block were moved into the archive, their
+    bookings stay counted"""
+    _archiving.active = True
+    try:
+        yield
+    finally:
+        _archiving.active = False
+
+
+@receiver(pre_delete, sender=TimeSlot)
+def uncount_deleted_time_slot(sender, instance, **kwargs):
+    if getattr(_archiving, 'active', False):
+        return
+    count_bookings(TimeSlot.people.through.objects.filter(
+        timeslot_id=instance.pk).values_list('user_id', 'timeslot__date'), -1)
+
+
+@receiver(post_save, sender=TimeSlot)
+def move_time_slot_bookings(sender, instance, created, **kwargs):
+    if created or not instance.tracker.has_changed('date'):
+        return
+    user_ids = list(instance.people.values_list('pk', flat=True))
+    count_bookings([(user_id, instance.tracker.previous('date')) for user_id in user_ids], -1)
+    count_bookings([(user_id, instance.date) for user_id in user_ids], 1)
+
+
+# version of the exported data, bumped once the change is committed
+
+@receiver(post_save, sender=TimeSlot)
+@receiver(post_delete, sender=TimeSlot)
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+@receiver(post_save, sender=Place)
+@receiver(post_delete, sender=Place)
+def schedule_changed(sender, **kwargs):
+    transaction.on_commit(ScheduleVersion.bump)
+
+
+@receiver(m2m_changed, sender=TimeSlot.people.through)
+@receiver(m2m_changed, sender=TimeSlot.allowed_groups.through)
+def schedule_relations_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        transaction.on_commit(ScheduleVersion.bump)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def users_changed(sender, **kwargs):
+    transaction.on_commit(UserVersion.bump)
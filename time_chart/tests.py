@@ -1,3 +1,762 @@
-from django.test import TestCase
+import datetime as dt
+import threading
+import time
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User as AdminUser
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from telegram import Bot, Chat, Message, Update
+from telegram import User as TelegramUser
+from telegram.ext import TypeHandler
+
+from time_chart.broadcast import DeliveryReport
+from time_chart.exports import AttendancePivot, attendance_rows, report_users, run_export_job
+from time_chart import availability, signals, webhook
+from time_chart.admin import TimeSlotAdmin
+from time_chart.archive import archive_time_slots
+from time_chart.management.commands import tools
+from time_chart.management.commands.bot_worker import PerUserDispatcher
+from time_chart.management.commands.config import (
+    ACCEPT_TERMS_STATE,
+    AUTOCOMPLETE_LIMIT,
+    DB_HEALTH_CHECK_INTERVAL,
+)
+from time_chart.models import (
+    ArchivedTimeSlot,
+    Attendance,
+    AttendanceRollup,
+    BotConversation,
+    BroadcastJob,
+    DailyBookings,
+    ExportJob,
+    Group,
+    Place,
+    Reservation,
+    ScheduleTemplate,
+    TimeSlot,
+    User,
+    ScheduleVersion,
+    WeeklyBookings,
+)
+from time_chart.pagination import estimated_count
+from time_chart.persistence import DatabasePersistence
+from time_chart.schedule import create_time_slots, materialize_templates
+
+
+# the manifest storage of the deployment needs collectstatic
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class ChangelistQueriesTest(TestCase):
+    """The admin changelists run the same number of queries for any page size"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = AdminUser.objects.create_superuser('admin', 'admin@example.com', 'password')
+        cls.place = Place.objects.create(name='Place')
+        cls.groups = [Group.objects.create(name=f'Group {i}') for i in range(3)]
+        cls.users = 0
+        cls.days = 0
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def add_users(self, count):
+        users = User.objects.bulk_create(
+            [User(id=self.users + i + 1, last_name=f'User {self.users + i}', group=self.groups[i % 3])
+             for i in range(count)])
+        self.users += count
+        return users
+
+    def add_time_slots(self, count):
+        users = self.add_users(2)
+        for _ in range(count):
+            self.days += 1
+            slot = TimeSlot.objects.create(place=self.place, date=dt.date.today() + dt.timedelta(days=self.days),
+                                           time=dt.time(10), open=True)
+            slot.people.add(*users)
+            slot.allowed_groups.add(*self.groups[:2])
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_time_slot_changelist(self):
+        self.add_time_slots(2)
+        queries = self.count_queries('/admin/time_chart/timeslot/')
+        self.add_time_slots(20)
+        self.assertEqual(self.count_queries('/admin/time_chart/timeslot/'), queries)
+
+    def test_time_slot_changelist_columns(self):
+        self.add_time_slots(1)
+        response = self.client.get('/admin/time_chart/timeslot/')
+        slot = response.context['cl'].result_list[0]
+        self.assertEqual((slot.people_count, slot.free_seats), (2, 6))
+        self.assertContains(response, 'Group 0, Group 1')
+
+    def test_user_changelist(self):
+        self.add_users(2)
+        queries = self.count_queries('/admin/time_chart/user/')
+        self.add_users(40)
+        self.assertEqual(self.count_queries('/admin/time_chart/user/'), queries)
+
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+@mock.patch.object(TimeSlotAdmin, 'list_per_page', 2)
+class KeysetPaginationTest(TestCase):
+    """Next and previous links, the date jump and bad cursors of the time slot changelist"""
+
+    url = '/admin/time_chart/timeslot/'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = AdminUser.objects.create_superuser('admin', 'admin@example.com', 'password')
+        places = [None, Place.objects.create(name='A'), Place.objects.create(name='B')]
+        tomorrow = dt.date.today() + dt.timedelta(days=1)
+        # in the changelist order: date, time, place with nulls first
+        cls.slots = [TimeSlot.objects.create(place=place, date=tomorrow + dt.timedelta(days=day), time=dt.time(10))
+                     for day in range(2) for place in places]
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def page(self, query=''):
+        response = self.client.get(self.url + query)
+        self.assertEqual(response.status_code, 200)
+        cl = response.context['cl']
+        return [slot.pk for slot in cl.result_list], cl.keyset
+
+    def pks(self, start, end):
+        return [slot.pk for slot in self.slots[start:end]]
+
+    def test_next_and_previous(self):
+        rows, keyset = self.page()
+        self.assertEqual(rows, self.pks(0, 2))
+        self.assertFalse(keyset['previous'])
+        rows, keyset = self.page(keyset['next'])
+        self.assertEqual(rows, self.pks(2, 4))
+        rows, last = self.page(keyset['next'])
+        self.assertEqual(rows, self.pks(4, 6))
+        self.assertFalse(last['next'])
+        self.assertEqual(self.page(last['previous'])[0], self.pks(2, 4))
+        rows, first = self.page(keyset['previous'])
+        self.assertEqual(rows, self.pks(0, 2))
+        self.assertFalse(first['previous'])
+
+    def test_go_to_date(self):
+        rows, keyset = self.page(f'?from={self.slots[3].date.isoformat()}')
+        self.assertEqual(rows, self.pks(3, 5))
+        self.assertEqual(self.page(keyset['previous'])[0], self.pks(1, 3))
+
+    def test_bad_cursors(self):
+        for query in ('?after=nonsense', '?before=2030-01-01_25:00_1', '?after=2030-01-01_10:00_x',
+                      '?from=tomorrow', f'?after=2030-01-01_10:00_{2 ** 70}'):
+            rows, keyset = self.page(query)
+            self.assertEqual(rows, [], query)
+            self.assertFalse(keyset['next'])
+
+    def test_estimated_count(self):
+        queryset = TimeSlot.objects.all()
+        cursor = mock.MagicMock()
+        cursor.__enter__.return_value.fetchone.return_value = ('[{"Plan": {"Plan Rows": 42}}]',)
+        with mock.patch.object(connection, 'vendor', 'postgresql'):
+            with mock.patch.object(connection, 'cursor', return_value=cursor):
+                self.assertEqual(estimated_count(queryset), 42)
+            # SQLite rejects the EXPLAIN, the rows are counted then
+            with self.assertLogs(level='ERROR'):
+                self.assertEqual(estimated_count(queryset), 6)
+
+
+
+class AvailabilityIndexTest(TransactionTestCase):
+    """The bot keyboards follow the bookings without asking the database again"""
+
+    def setUp(self):
+        availability.index.clear()
+        self.addCleanup(availability.index.clear)
+        self.place = Place.objects.create(name='Place')
+        self.group = Group.objects.create(name='Group', allow_signup=True)
+        self.other_group = Group.objects.create(name='Other')
+        self.date = dt.date.today() + dt.timedelta(days=2)
+        self.free = TimeSlot.objects.create(place=self.place, date=self.date, time=dt.time(10), open=True, limit=1)
+        self.restricted = TimeSlot.objects.create(place=self.place, date=self.date, time=dt.time(12), open=True)
+        self.restricted.allowed_groups.add(self.other_group)
+
+    def times(self, group):
+        return [pk for pk, _, _ in availability.index.times('Place', self.date, group.pk)]
+
+    def test_groups(self):
+        self.assertEqual(availability.index.dates('Place', self.group.pk, dt.date.today()), [self.date])
+        self.assertEqual(self.times(self.group), [self.free.pk])
+        self.assertEqual(self.times(self.other_group), [self.free.pk, self.restricted.pk])
+
+    def test_follows_bookings_and_changes(self):
+        self.times(self.group)
+        user = User.objects.create(id=1, last_name='User', group=self.group)
+        self.assertEqual(self.free.reserve(user), Reservation.BOOKED)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.times(self.group), [])
+            self.assertEqual(availability.index.dates('Place', self.group.pk, dt.date.today()), [])
+        self.restricted.allowed_groups.clear()
+        self.assertEqual(self.times(self.group), [self.restricted.pk])
+        self.restricted.delete()
+        self.assertEqual(self.times(self.other_group), [])
+
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class UserAutocompleteTest(TransactionTestCase):
+    """The autocomplete is capped and cached until a user or a group changes"""
+
+    url = '/admin/user-autocomplete/'
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(AdminUser.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        self.group = Group.objects.create(name='Group')
+        User.objects.bulk_create([User(id=i, last_name=f'Name {i}', group=self.group)
+                                  for i in range(1, AUTOCOMPLETE_LIMIT + 6)])
+
+    def search(self, q):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.url, {'q': q})
+        self.assertEqual(response.status_code, 200)
+        user_queries = [query for query in context.captured_queries if 'FROM "time_chart_user"' in query['sql']]
+        return [result['text'] for result in response.json()['results']], len(user_queries)
+
+    def test_limit(self):
+        pages = []
+        while not pages or pages[-1]['pagination']['more']:
+            response = self.client.get(self.url, {'q': 'name', 'page': len(pages) + 1})
+            pages.append(response.json())
+        self.assertEqual(sum(len(page['results']) for page in pages), AUTOCOMPLETE_LIMIT)
+        self.assertEqual(self.search('3')[0], ['Name 3  (Group)'])
+
+    def test_cache(self):
+        self.assertTrue(self.search('name 1')[1])
+        self.assertEqual(self.search('name 1')[1], 0)
+        # bookings do not concern the users
+        TimeSlot.objects.create(date=MONDAY, time=dt.time(10)).people.add(User.objects.get(pk=1))
+        self.assertEqual(self.search('name 1')[1], 0)
+        self.group.name = 'Renamed'
+        self.group.save()
+        names, queries = self.search('name 1')
+        self.assertTrue(queries)
+        self.assertIn('Name 1  (Renamed)', names)
+
+
+
+def telegram_update(user_id, chat_id=None, text='text'):
+    chat = Chat(chat_id or user_id, Chat.PRIVATE)
+    message = Message(1, TelegramUser(user_id, 'First', False), dt.datetime(2021, 3, 1), chat, text=text)
+    return Update(1, message=message)
+
+
+class DatabasePersistenceTest(TestCase):
+    """The bot data and the conversation states go through the database
+    between processes"""
+
+    def process(self):
+        """A persistence as a new process sees it"""
+        persistence = DatabasePersistence()
+        dispatcher = SimpleNamespace(user_data=persistence.get_user_data(), chat_data=persistence.get_chat_data())
+        return persistence, dispatcher
+
+    def test_data_round_trip(self):
+        first, _ = self.process()
+        first.update_user_data(5, {'place': 'Place'})
+        first.update_chat_data(7, {'step': 1})
+        with self.assertNumQueries(0):
+            first.update_user_data(5, {'place': 'Place'})
+
+        second, dispatcher = self.process()
+        self.assertEqual(dispatcher.user_data[5], {'place': 'Place'})
+        user_data = dispatcher.user_data[5]
+        first.update_user_data(5, {'place': 'Other'})
+        second.refresh(dispatcher, telegram_update(5, 7))
+        self.assertEqual(user_data, {'place': 'Other'})
+        self.assertEqual(dispatcher.chat_data[7], {'step': 1})
+
+    def test_conversations(self):
+        first, _ = self.process()
+        second, dispatcher = self.process()
+        conversations = second.get_conversations('subscribe')
+        first.update_conversation('subscribe', (7, 5), 3)
+        second.refresh(dispatcher, telegram_update(5, 7))
+        self.assertEqual(conversations, {(7, 5): 3})
+        with self.assertNumQueries(0):
+            self.assertEqual(conversations.get((7, 5)), 3)
+
+        first.update_conversation('subscribe', (7, 5), 4)
+        second.refresh(dispatcher, telegram_update(5, 7))
+        self.assertEqual(conversations, {(7, 5): 4})
+        first.update_conversation('subscribe', (7, 5), None)
+        second.refresh(dispatcher, telegram_update(5, 7))
+        self.assertEqual(conversations, {})
+
+    def test_conversation_created_by_another_process(self):
+        persistence, _ = self.process()
+        persistence.update_conversation('subscribe', (7, 5), 3)
+        filter_ = BotConversation.objects.filter
+        calls = []
+
+        def first_update_misses_the_row(*args, **kwargs):
+            calls.append(kwargs)
+            return filter_(*args, **kwargs).none() if len(calls) == 1 else filter_(*args, **kwargs)
+
+        with mock.patch.object(BotConversation.objects, 'filter', first_update_misses_the_row):
+            persistence.update_conversation('subscribe', (7, 5), 4)
+        self.assertEqual(BotConversation.objects.get().state, 4)
+
+
+class PerUserDispatcherTest(TestCase):
+    """The updates of one user are processed in order, the ones of different
+    users concurrently"""
+
+    def dispatcher(self, lanes, callback):
+        dispatcher = PerUserDispatcher(Bot('123:abc'), None, workers=0, use_context=True, lanes=lanes)
+        dispatcher.add_handler(TypeHandler(Update, callback))
+        self.addCleanup(dispatcher.stop)
+        return dispatcher
+
+    def test_lanes(self):
+        processed = []
+        other_user_done = threading.Event()
+
+        def callback(update, context):
+            text = update.message.text
+            if text == 'first':
+                # blocks the lane of the user until the other user is served
+                self.assertTrue(other_user_done.wait(5))
+            processed.append(text)
+            if text == 'other':
+                other_user_done.set()
+
+        dispatcher = self.dispatcher(2, callback)
+        dispatcher.process_update(telegram_update(1, text='first'))
+        dispatcher.process_update(telegram_update(1, text='second'))
+        dispatcher.process_update(telegram_update(2, text='other'))
+        dispatcher.stop()
+        self.assertEqual(processed, ['other', 'first', 'second'])
+
+    def test_no_lanes(self):
+        threads = []
+        dispatcher = self.dispatcher(0, lambda update, context: threads.append(threading.current_thread()))
+        dispatcher.process_update(telegram_update(1))
+        self.assertEqual(threads, [threading.current_thread()])
+
+
+class DbConnectionTest(TransactionTestCase):
+    """Handlers check a connection idle for long before using it"""
+
+    def setUp(self):
+        connection.ensure_connection()
+        self.addCleanup(vars(tools._connection_state).clear)
+
+    def call(self, idle, usable=True, handler=lambda: None):
+        tools._connection_state.last_used = time.monotonic() - idle
+        with mock.patch.object(connection, 'is_usable', return_value=usable) as is_usable, \
+                mock.patch.object(connection, 'close') as close:
+            tools.db_connection(handler)()
+        return is_usable.call_count, close.call_count
+
+    def test_recently_used(self):
+        self.assertEqual(self.call(idle=0), (0, 0))
+
+    def test_idle(self):
+        self.assertEqual(self.call(idle=DB_HEALTH_CHECK_INTERVAL + 1), (1, 0))
+        self.assertEqual(self.call(idle=DB_HEALTH_CHECK_INTERVAL + 1, usable=False), (1, 1))
+
+    def test_last_used_after_error(self):
+        def handler():
+            raise ValueError
+
+        with self.assertRaises(ValueError):
+            self.call(idle=DB_HEALTH_CHECK_INTERVAL + 1, handler=handler)
+        self.assertLess(time.monotonic() - tools._connection_state.last_used, 1)
+
+
+# a /start message as posted by Telegram
+START_UPDATE = {
+    'update_id': 1,
+    'message': {
+        'message_id': 1,
+        'date': 1614556800,
+        'from': {'id': 20, 'is_bot': False, 'first_name': 'First', 'username': 'nick'},
+        'chat': {'id': 20, 'type': 'private', 'first_name': 'First'},
+        'text': '/start',
+        'entities': [{'offset': 0, 'length': 6, 'type': 'bot_command'}],
+    },
+}
+
+
+@mock.patch.object(webhook, 'WEBHOOK_SECRET', 'secret')
+@mock.patch.object(webhook, '_dispatcher', None)
+@mock.patch.object(Bot, 'username', 'bot')
+class WebhookTest(TransactionTestCase):
+    """Telegram updates posted to the webhook are handled in the request"""
+
+    def post(self, secret, data):
+        return self.client.post(f'/bot/{secret}/', data, content_type='application/json')
+
+    def test_wrong_secret(self):
+        with mock.patch.object(Bot, 'send_message') as send_message:
+            self.assertEqual(self.post('wrong', START_UPDATE).status_code, 404)
+        send_message.assert_not_called()
+        self.assertFalse(User.objects.exists())
+
+    def test_bad_json(self):
+        self.assertEqual(self.post('secret', '{').status_code, 400)
+
+    def test_update(self):
+        with mock.patch.object(Bot, 'send_message') as send_message:
+            self.assertEqual(self.post('secret', START_UPDATE).status_code, 200)
+        self.assertEqual(send_message.call_args[1]['chat_id'], 20)
+        self.assertEqual(User.objects.values_list('id', 'bot_chat_id', 'nick_name').get(), (20, 20, 'nick'))
+        self.assertEqual(BotConversation.objects.get(name='identity_conversation').state, ACCEPT_TERMS_STATE)
+
+
+class BroadcastJobTest(TestCase):
+    """Allowing a group to sign up queues one notification for its users"""
+
+    def setUp(self):
+        self.group = Group.objects.create(name='Group')
+        User.objects.create(id=1, last_name='With chat', group=self.group, bot_chat_id=10)
+        User.objects.create(id=2, last_name='Without chat', group=self.group)
+        User.objects.create(id=3, last_name='Inactive', group=self.group, bot_chat_id=30, is_active=False)
+
+    def test_queued_once(self):
+        self.group.allow_signup = True
+        self.group.save()
+        self.group.name = 'Renamed'
+        self.group.save()
+        job = BroadcastJob.objects.get()
+        self.assertEqual((job.status, job.chat_ids), (BroadcastJob.PENDING, [10]))
+
+    def test_report_stored(self):
+        self.group.allow_signup = True
+        self.group.save()
+        report = DeliveryReport(sent=[], failed={10: 'Forbidden'}, retries=1, elapsed=0.5)
+        with mock.patch('time_chart.broadcast.broadcast', return_value=report):
+            call_command('broadcast_worker', '--once')
+        job = BroadcastJob.objects.get()
+        self.assertEqual((job.status, job.sent, job.failed, job.retries), (BroadcastJob.DONE, 0, {'10': 'Forbidden'}, 1))
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class ExportJobTest(TestCase):
+    """Export jobs are claimed by one worker and their files streamed in parts"""
+
+    def test_claim(self):
+        first, second = [ExportJob.objects.create(kind=ExportJob.SCHEDULE) for _ in range(2)]
+        self.assertEqual(ExportJob.claim(60), first)
+        self.assertEqual(ExportJob.claim(60), second)
+        self.assertIsNone(ExportJob.claim(60))
+        self.assertEqual(ExportJob.objects.get(pk=first.pk).status, ExportJob.RUNNING)
+
+    def test_claim_abandoned(self):
+        job = ExportJob.objects.create(kind=ExportJob.SCHEDULE, status=ExportJob.RUNNING,
+                                       started=timezone.now() - dt.timedelta(seconds=120))
+        self.assertIsNone(ExportJob.claim(300))
+        self.assertEqual(ExportJob.claim(60), job)
+        # the job restarted, the other workers leave it alone
+        self.assertIsNone(ExportJob.claim(60))
+
+    def test_queue_reuses_job(self):
+        job = ExportJob.queue(ExportJob.REPORT, [2, 1])
+        self.assertEqual(ExportJob.queue(ExportJob.REPORT, [1, 2]), job)
+        self.assertNotEqual(ExportJob.queue(ExportJob.REPORT, [1]), job)
+        self.assertNotEqual(ExportJob.queue(ExportJob.SCHEDULE, [1, 2]), job)
+
+        ExportJob.objects.filter(pk=job.pk).update(status=ExportJob.FAILED)
+        retried = ExportJob.queue(ExportJob.REPORT, [1, 2])
+        self.assertNotEqual(retried, job)
+
+        ScheduleVersion.bump()
+        self.assertNotEqual(ExportJob.queue(ExportJob.REPORT, [1, 2]), retried)
+
+    @mock.patch('time_chart.exports.EXPORT_FILE_PART_SIZE', 1000)
+    def test_parts(self):
+        place = Place.objects.create(name='Place')
+        for hour in range(10, 20):
+            TimeSlot.objects.create(place=place, date=MONDAY, time=dt.time(hour))
+        ExportJob.objects.create(kind=ExportJob.SCHEDULE)
+        job = ExportJob.claim(60)
+        self.assertTrue(run_export_job(job))
+        job.refresh_from_db()
+        self.assertEqual(job.status, ExportJob.DONE)
+        self.assertGreater(job.file_parts.count(), 1)
+
+        self.client.force_login(AdminUser.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        response = self.client.get(f'/admin/time_chart/exportjob/{job.pk}/status/?download')
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content)
+        self.assertEqual((len(content), content[:2]), (job.size, b'PK'))
+
+
+class AttendanceReportTest(TestCase):
+    """The streamed rows and the XLSX pivot list the users in the same order"""
+
+    def test_rows_in_report_order(self):
+        place = Place.objects.create(name='Place')
+        users = [User.objects.create(id=i, last_name=name) for i, name in ((1, 'Zeta'), (2, 'Alpha'), (3, 'Mu'))]
+        monday = dt.date(2021, 3, 1)
+        for days, user in enumerate(users):
+            slot = TimeSlot.objects.create(place=place, date=monday + dt.timedelta(days=days), time=dt.time(10))
+            slot.people.add(user)
+        slot.people.add(users[0])
+
+        queryset = report_users(User.objects.all())
+        rows = list(attendance_rows(queryset))
+        self.assertEqual(rows, [
+            (2, 'Alpha', 2021, 9, 'Place', 'Вт'),
+            (3, 'Mu', 2021, 9, 'Place', 'Ср'),
+            (1, 'Zeta', 2021, 9, 'Place', 'Пн, Ср'),
+        ])
+        pivot = AttendancePivot(queryset)
+        self.assertEqual([user_id for user_id, _ in pivot.users], [row[0] for row in rows])
+        self.assertEqual(pivot.days(1, (2021, 9), 'Place'), 'Пн, Ср')
+
+
+class CreateTimeSlotsTest(TestCase):
+    """Only the slots created by the call are counted and get the groups"""
+
+    def setUp(self):
+        self.place = Place.objects.create(name='Place')
+        self.group = Group.objects.create(name='Group')
+        self.dates = [dt.date(2030, 1, day) for day in (1, 2, 3)]
+
+    def create(self):
+        return create_time_slots([self.place.pk], self.dates, [dt.time(10)], True, 8, [self.group.pk])
+
+    def test_existing_slot_left_alone(self):
+        TimeSlot.objects.create(place=self.place, date=self.dates[0], time=dt.time(10), limit=4)
+        self.assertEqual(self.create(), 2)
+        self.assertEqual(self.create(), 0)
+        existing = TimeSlot.objects.get(date=self.dates[0])
+        self.assertEqual((existing.limit, existing.allowed_groups.count()), (4, 0))
+
+    def test_slot_added_in_the_meantime(self):
+        TimeSlot.objects.create(place=self.place, date=self.dates[1], time=dt.time(10))
+        filter_ = TimeSlot.objects.filter
+        reads = []
+
+        def first_read_misses_the_slot(*args, **kwargs):
+            reads.append(kwargs)
+            queryset = filter_(*args, **kwargs)
+            return queryset.exclude(date=self.dates[1]) if len(reads) == 1 else queryset
+
+        with mock.patch.object(TimeSlot.objects, 'filter', first_read_misses_the_slot):
+            self.assertEqual(self.create(), 2)
+        self.assertEqual(TimeSlot.objects.get(date=self.dates[1]).allowed_groups.count(), 0)
+        self.assertEqual(TimeSlot.objects.filter(allowed_groups=self.group).count(), 2)
+
+    def test_other_errors_raised(self):
+        with self.assertRaises(IntegrityError):
+            create_time_slots([self.place.pk], self.dates, [dt.time(10)], True, -1)
+
+
+class MaterializeTemplatesTest(TestCase):
+    """Every run continues the templates after the last materialized date"""
+
+    def setUp(self):
+        self.today = dt.date.today()
+        self.group = Group.objects.create(name='Group')
+        self.template = ScheduleTemplate.objects.create(
+            place=Place.objects.create(name='Place'), weekday=self.today.weekday(), time=dt.time(10))
+        self.template.groups.add(self.group)
+        ScheduleTemplate.objects.create(place=self.template.place, weekday=self.today.weekday(),
+                                        time=dt.time(12), is_active=False)
+
+    def materialize(self, days, start=None):
+        return materialize_templates(ScheduleTemplate.objects.all(), self.today + dt.timedelta(days=days), start)
+
+    def test_materialize(self):
+        self.assertEqual(self.materialize(13), 2)
+        self.template.refresh_from_db()
+        self.assertEqual(self.template.materialized_until, self.today + dt.timedelta(days=13))
+        self.assertEqual(TimeSlot.objects.filter(time=dt.time(10), allowed_groups=self.group).count(), 2)
+        self.assertEqual(self.materialize(13), 0)
+
+        # a slot removed in the admin stays removed
+        TimeSlot.objects.get(date=self.today).delete()
+        self.assertEqual(self.materialize(20), 1)
+        self.template.refresh_from_db()
+        self.assertEqual(self.template.materialized_until, self.today + dt.timedelta(days=20))
+        self.assertEqual(self.materialize(20, start=self.today), 1)
+        self.assertEqual(TimeSlot.objects.count(), 3)
+
+
+class ApiCachingTest(TestCase):
+    """Only the answers of the API are cached, the errors must not be stored"""
+
+    def test_answer_cached(self):
+        response = self.client.get('/api/availability/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('public', response['Cache-Control'])
+        response = self.client.get('/api/availability/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertIn('public', response['Cache-Control'])
+
+    def test_error_not_stored(self):
+        response = self.client.get('/api/availability/?date=tomorrow')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response['Cache-Control'], 'no-store')
+        self.assertFalse(response.has_header('ETag'))
+
+
+MONDAY = dt.date(2030, 1, 7)
+
+
+class ReserveTest(TestCase):
+    """Every outcome of ``TimeSlot.reserve``"""
+
+    def setUp(self):
+        self.place = Place.objects.create(name='Place')
+        self.group = Group.objects.create(name='Group', allow_signup=True, week_limit=2)
+        self.user = User.objects.create(id=1, last_name='User', group=self.group)
+
+    def slot(self, days=0, time=dt.time(10), open=True, **kwargs):
+        return TimeSlot.objects.create(place=self.place, date=MONDAY + dt.timedelta(days=days), time=time,
+                                       open=open, **kwargs)
+
+    def test_booked(self):
+        slot = self.slot()
+        self.assertEqual(slot.reserve(self.user), Reservation.BOOKED)
+        self.assertEqual(list(slot.people.all()), [self.user])
+
+    def test_closed(self):
+        self.assertEqual(self.slot(open=False).reserve(self.user), Reservation.CLOSED)
+        other_group_only = self.slot(days=1)
+        other_group_only.allowed_groups.add(Group.objects.create(name='Other'))
+        self.assertEqual(other_group_only.reserve(self.user), Reservation.CLOSED)
+        Group.objects.filter(pk=self.group.pk).update(allow_signup=False)
+        self.assertEqual(self.slot(days=2).reserve(self.user), Reservation.CLOSED)
+
+    def test_full(self):
+        slot = self.slot(limit=1)
+        slot.people.add(User.objects.create(id=2, last_name='Other', group=self.group))
+        self.assertEqual(slot.reserve(self.user), Reservation.FULL)
+
+    def test_day_taken(self):
+        self.slot().reserve(self.user)
+        later = self.slot(time=dt.time(12))
+        self.assertEqual(later.reserve(self.user), Reservation.DAY_TAKEN)
+        self.assertEqual(later.reserve(self.user, check_quota=False), Reservation.BOOKED)
+
+    def test_over_quota(self):
+        self.slot().reserve(self.user)
+        self.slot(days=1).reserve(self.user)
+        self.assertEqual(self.slot(days=2).reserve(self.user), Reservation.OVER_QUOTA)
+        # the next ISO week has its own quota
+        self.assertEqual(self.slot(days=7).reserve(self.user), Reservation.BOOKED)
+
+class BookingCountersTest(TestCase):
+    """The weekly and daily counters follow every change of the bookings"""
+
+    def setUp(self):
+        self.place = Place.objects.create(name='Place')
+        self.users = [User.objects.create(id=i, last_name=f'User {i}') for i in (1, 2)]
+        self.slot = TimeSlot.objects.create(place=self.place, date=MONDAY, time=dt.time(10))
+
+    def assertCounters(self, user, day, bookings):
+        self.assertEqual((WeeklyBookings.of(user.pk, day), DailyBookings.of(user.pk, day)), (bookings, bookings))
+
+    def test_add_and_remove(self):
+        self.slot.people.add(*self.users)
+        self.slot.people.add(self.users[0])
+        self.assertCounters(self.users[0], MONDAY, 1)
+        self.slot.people.remove(self.users[0])
+        self.assertCounters(self.users[0], MONDAY, 0)
+        self.assertCounters(self.users[1], MONDAY, 1)
+        self.slot.people.clear()
+        self.assertCounters(self.users[1], MONDAY, 0)
+
+    def test_add_from_the_user(self):
+        other = TimeSlot.objects.create(place=self.place, date=MONDAY + dt.timedelta(days=1), time=dt.time(10))
+        self.users[0].timeslot_set.add(self.slot, other)
+        self.assertEqual(WeeklyBookings.of(self.users[0].pk, MONDAY), 2)
+        self.users[0].timeslot_set.clear()
+        self.assertEqual(WeeklyBookings.of(self.users[0].pk, MONDAY), 0)
+
+    def test_slot_deleted(self):
+        self.slot.people.add(*self.users)
+        self.slot.delete()
+        self.assertCounters(self.users[0], MONDAY, 0)
+        self.assertCounters(self.users[1], MONDAY, 0)
+
+    def test_slot_moved(self):
+        self.slot.people.add(self.users[0])
+        next_week = MONDAY + dt.timedelta(days=7)
+        self.slot.date = next_week
+        self.slot.save()
+        self.assertCounters(self.users[0], MONDAY, 0)
+        self.assertCounters(self.users[0], next_week, 1)
+
+
+class ArchiveTest(TestCase):
+    """Archived bookings keep their counters and stay in the user report"""
+
+    def test_archive(self):
+        place = Place.objects.create(name='Place')
+        user = User.objects.create(id=1, last_name='User')
+        past = dt.date.today() - dt.timedelta(days=30)
+        slots = [TimeSlot.objects.create(place=place, date=past, time=dt.time(hour)) for hour in (10, 12)]
+        for slot in slots:
+            slot.people.add(user)
+            slot.allowed_groups.add(Group.objects.create(name=f'Group {slot.pk}'))
+        rows = list(attendance_rows(User.objects.all()))
+
+        self.assertEqual(archive_time_slots(dt.date.today(), batch_size=1), (2, 2))
+        self.assertFalse(TimeSlot.objects.exists())
+        self.assertFalse(TimeSlot.allowed_groups.through.objects.exists())
+        self.assertEqual(set(ArchivedTimeSlot.objects.values_list('pk', flat=True)), {slot.pk for slot in slots})
+        self.assertEqual((WeeklyBookings.of(user.pk, past), DailyBookings.of(user.pk, past)), (2, 2))
+        self.assertEqual(list(attendance_rows(User.objects.all())), rows)
+
+    def test_deleted_slot_stays_counted(self):
+        user = User.objects.create(id=1, last_name='User')
+        slot = TimeSlot.objects.create(date=MONDAY, time=dt.time(10))
+        slot.people.add(user)
+        with signals.archiving():
+            slot.delete()
+        self.assertEqual(DailyBookings.of(user.pk, MONDAY), 1)
+
+
+class RollupAttendanceTest(TestCase):
+    """Rolling up the attendance again does not count the bookings twice"""
+
+    def setUp(self):
+        today = dt.date.today()
+        AttendanceRollup.objects.filter(pk=1).update(date=today - dt.timedelta(days=7))
+        place = Place.objects.create(name='Place')
+        users = [User.objects.create(id=i, last_name=f'User {i}') for i in (1, 2)]
+        for days_ago, people in ((3, users), (2, users[:1]), (0, users)):
+            slot = TimeSlot.objects.create(place=place, date=today - dt.timedelta(days=days_ago), time=dt.time(10))
+            slot.people.add(*people)
+        self.visits = {1: 2, 2: 1}
+
+    def rollup(self, *args):
+        call_command('rollup_attendance', *args, stdout=StringIO())
+        return dict(Attendance.objects.values_list('user_id', 'visits'))
+
+    def test_incremental(self):
+        self.assertEqual(Attendance.visits_of([1, 2]), self.visits)
+        self.assertEqual(self.rollup(), self.visits)
+        self.assertEqual(AttendanceRollup.until(), dt.date.today())
+        self.assertEqual(self.rollup(), self.visits)
+        self.assertEqual(Attendance.visits_of([1, 2]), self.visits)
+
+    def test_rebuild(self):
+        self.assertEqual(self.rollup('--rebuild'), self.visits)
+        self.assertEqual(self.rollup('--rebuild'), self.visits)
+        self.assertEqual(self.rollup(), self.visits)
+        self.assertEqual(Attendance.visits_of([1, 2]), self.visits)
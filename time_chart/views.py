@@ -1,31 +1,52 @@
 import datetime as dt
-from itertools import product
+import hashlib
 
 from dal import autocomplete
 from django import forms
 from django.contrib import messages
-from django.shortcuts import redirect, render
-from django.views.generic import FormView
+from django.core.cache import cache
+from django.db.models import Q
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404, redirect, render
+from django.views.generic import FormView, View
 
-from time_chart.models import Group, Place, TimeSlot, User
+from time_chart.management.commands.config import AUTOCOMPLETE_CACHE_TTL, AUTOCOMPLETE_LIMIT
+from time_chart.models import ExportJob, Group, Place, User, UserVersion
+from time_chart.schedule import create_time_slots
 
 
 class UserAutocomplete(autocomplete.Select2QuerySetView):
+    """People of the time slot form
+
+    Matches the id or the beginning of the last, first or nick name (the
+    name lookups are indexed, see migration 0021), returns at most
+    AUTOCOMPLETE_LIMIT users and caches the responses for
+    AUTOCOMPLETE_CACHE_TTL seconds per ``UserVersion``, which changes with
+    every change of the users and the groups.
+    """
+
+    def get(self, request, *args, **kwargs):
+        key = f'{UserVersion.current()}:{self.q}:{request.GET.get("page", "")}'
+        key = 'user-autocomplete:' + hashlib.md5(key.encode()).hexdigest()
+        content = cache.get(key)
+        if content is not None:
+            return HttpResponse(content, content_type='application/json')
+        response = super().get(request, *args, **kwargs)
+        cache.set(key, response.content, AUTOCOMPLETE_CACHE_TTL)
+        return response
+
     def get_queryset(self):
-        qs = User.objects.select_related('group')
-        if self.q:
-            q = None
-            try:
-                q = int(self.q)
-            except ValueError:
-                pass
-
-            if q:
-                qs = qs.filter(id=q)
+        qs = User.objects.select_related('group').order_by('last_name', 'first_name')
+        q = self.q.strip()
+        if q:
+            if q.isdigit():
+                qs = qs.filter(id=int(q))
             else:
-                qs = qs.filter(last_name__istartswith=self.q)
+                qs = qs.filter(Q(last_name__istartswith=q)
+                               | Q(first_name__istartswith=q)
+                               | Q(nick_name__istartswith=q))
 
-        return qs.all()
+        return qs[:AUTOCOMPLETE_LIMIT]
 
     def get_result_label(self, item):
         return f"{item.last_name} {item.first_name} ({item.group.name})"
@@ -78,33 +99,47 @@ class DefineScheduleView(FormView):
             # TODO: how to show form invalid
             return redirect('/admin/time_chart/timeslot/create-schedule/')
 
-        time_slots = []
-        open = form.cleaned_data['open']
         start_date = form.cleaned_data['start_date']
         end_date = form.cleaned_data['end_date']
-        limit = form.cleaned_data['limit']
         if start_date > end_date:
             messages.add_message(self.request, messages.WARNING,
                                  "end_date should be greater than start_date")
             return redirect('/admin/time_chart/timeslot/create-schedule/')
-        if (end_date - start_date).days > 7:
-            messages.add_message(self.request, messages.WARNING,
-                                 "You are trying to add too many days into schedule")
-            return redirect('/admin/time_chart/timeslot/create-schedule/')
-        dates = []
-        date = start_date
-        while date <= end_date:
-            dates.append(date)
-            date += dt.timedelta(days=1)
-        groups = form.cleaned_data['groups']
-        for place, date, time in product(form.cleaned_data['place'],
-                                         dates,
-                                         form.cleaned_data['time']):
-            ts = TimeSlot(place=place, date=date, time=time, open=open, limit=limit)
-            ts.save()
-            ts.allowed_groups.set(groups or [])
-            time_slots.append(ts)
-            ts.save()
+        dates = [start_date + dt.timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+        times = [dt.time.fromisoformat(t) for t in form.cleaned_data['time']]
+        created = create_time_slots(
+            [place.pk for place in form.cleaned_data['place']],
+            dates,
+            times,
+            open=form.cleaned_data['open'],
+            limit=form.cleaned_data['limit'],
+            group_ids=[group.pk for group in form.cleaned_data['groups']],
+        )
         messages.add_message(self.request, messages.WARNING,
-                             "TimeSlots are created")
+                             f"{created} TimeSlots are created")
         return redirect('/admin/time_chart/timeslot')
+
+
+class ExportJobView(View):
+    """Status of an export job, reloads itself until the file is ready
+
+    ``?download`` streams the file of a finished job part by part.
+    """
+    template_name = 'admin/export_job.html'
+    refresh = 3  # seconds
+
+    def get(self, request, pk):
+        job = get_object_or_404(ExportJob, pk=pk)
+        if 'download' in request.GET:
+            if job.status != ExportJob.DONE:
+                raise Http404('The export is not ready')
+            response = StreamingHttpResponse(job.parts(), content_type='application/vnd.ms-excel')
+            response['Content-Length'] = job.size
+            response['Content-Disposition'] = f'attachment; filename="{job.filename}"'
+            return response
+        context = {
+            'job': job,
+            'refresh': self.refresh,
+            'title': str(job),
+        }
+        return render(request, self.template_name, context)
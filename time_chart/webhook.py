@@ -0,0 +1,65 @@
+"""Telegram webhook endpoint
+
+Telegram posts every update as JSON to ``/bot/<WEBHOOK_SECRET>/``. The update
+is handled in the request by a dispatcher set up with the same handlers as the
+polling ``bot_worker``, so the bot runs inside the web processes and scales
+with them. Consecutive updates of a user can reach different processes: the
+conversation states and the user data live in the database (see
+``time_chart.persistence``) and are read again for every update, so the
+dispatcher refuses conversation handlers that are not persistent. A recorded
+update can be replayed locally with e.g.
+``curl -d @update.json -H 'Content-Type: application/json' localhost:8000/bot/<secret>/``.
+"""
+import json
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+from django.http import Http404, HttpResponse, HttpResponseBadRequest
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from telegram import Bot, Update
+from telegram.ext import ConversationHandler, Dispatcher
+
+from time_chart.management.commands.bot_worker import make_persistence, setup_dispatcher
+from time_chart.management.commands.config import BOT_TOKEN, WEBHOOK_SECRET
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            dispatcher = Dispatcher(Bot(BOT_TOKEN), None, workers=0, use_context=True,
+                                    persistence=make_persistence())
+            setup_dispatcher(dispatcher)
+            check_persistent(dispatcher)
+            _dispatcher = dispatcher
+    return _dispatcher
+
+
+def check_persistent(dispatcher):
+    """Raise ImproperlyConfigured for a conversation kept in the process memory
+    or one the persistence can not reload (per message)"""
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, ConversationHandler) and (not handler.persistent or handler.per_message):
+                raise ImproperlyConfigured(f'Conversation handler {handler.name} must be persistent '
+                                           f'and not per message to be served by the webhook')
+
+
+@csrf_exempt
+@require_POST
+def webhook(request, secret):
+    if not WEBHOOK_SECRET or not constant_time_compare(secret, WEBHOOK_SECRET):
+        raise Http404
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+    except ValueError:
+        return HttpResponseBadRequest()
+
+    dispatcher = get_dispatcher()
+    dispatcher.process_update(Update.de_json(data, dispatcher.bot))
+    return HttpResponse()